@@ -3,10 +3,22 @@
 """
 from twisted.internet import reactor
 from txjsonrpcqueue.wildcardqueue import WildcardQueue
-from txjsonrpcqueue.rpcforwarder import RpcForwarder
+from txjsonrpcqueue.rpcforwarder import RpcForwarder, ConnectionPool
 from txjsonrpcqueue.exception import HttpError, HttpServerError, HttpClientError
 from txjsonrpcqueue.exception import JsonRpcBatchError, JsonRpcCommandError
-from txjsonrpcqueue.exception import JsonRpcCommandResponseError
+from txjsonrpcqueue.exception import JsonRpcCommandResponseError, DeadlineExceeded
+from txjsonrpcqueue.core.batchsize import AdaptiveBatchSize
+from txjsonrpcqueue.core.cache import ResponseCache
+from txjsonrpcqueue.core.hedge import HedgePolicy
+from txjsonrpcqueue.core.retry import RetryPolicy
+from txjsonrpcqueue.core.merge import CallMerger, MergeRule
+from txjsonrpcqueue.core.codec import JsonCodec, get_codec, available_codecs
+from txjsonrpcqueue.core.compression import Compression
+from txjsonrpcqueue.core.metrics import MetricsRegistry
+from txjsonrpcqueue.core.mocknode import MockNode
+from txjsonrpcqueue.core.recorder import Recorder, ReplayNode, read_recording
+from txjsonrpcqueue.metrics import listen_metrics
+from txjsonrpcqueue.mocknode import listen_mock_node
 
 #Twisted implementation of an object with portable operations
 class Portable(object):
@@ -30,10 +42,21 @@ class Portable(object):
         #pylint: disable=no-member,invalid-name
         reactor.callLater(time, func, *args)
     def make_wildcard_queue(self, low=8000, high=10000, highwater=None,
-                            lowwater=None, namespace=None):
+                            lowwater=None, namespace=None, coalesce=False,
+                            cache=None, default_deadline=None, lanes=None,
+                            lane_weights=None, lane_watermarks=None, namespace_lanes=None,
+                            codec=None, backpressure=False, max_wait=None):
         """Twisted implementation of factory method for making a WildcardQueue"""
         #pylint: disable=too-many-arguments
-        return WildcardQueue(low, high, highwater, lowwater, namespace)
-    def make_rpc_forwarder(self, queue, host_injector=None, host_url=None):
+        return WildcardQueue(low, high, highwater, lowwater, namespace, coalesce, cache,
+                             default_deadline, lanes, lane_weights, lane_watermarks,
+                             namespace_lanes, codec, backpressure, max_wait)
+    def make_rpc_forwarder(self, queue, host_injector=None, host_url=None, max_inflight=1,
+                           pool=None, batch_size=None, hedge=None, timeout=None,
+                           retry=None, codec=None, stream=True, compression=None,
+                           metrics=None, recorder=None, merger=None):
         """Twisted implementation of factory method for making a RpcForwarder"""
-        return RpcForwarder(queue, host_injector, host_url)
+        #pylint: disable=too-many-arguments
+        return RpcForwarder(queue, host_injector, host_url, max_inflight, pool,
+                            batch_size, hedge, timeout, retry, codec, stream, compression,
+                            metrics, recorder, merger)
@@ -0,0 +1,25 @@
+"""Asyncio Prometheus endpoint for a MetricsRegistry"""
+from aiohttp import web
+
+def metrics_handler(registry):
+    """aiohttp request handler serving the metrics in the Prometheus text format"""
+    async def handler(request):
+        """Prometheus scrape"""
+        #pylint: disable=unused-argument
+        return web.Response(body=registry.prometheus().encode("utf8"),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+    return handler
+
+async def listen_metrics(registry, port=9100, interface="127.0.0.1"):
+    """Serve the metrics on http://interface:port/ , returns the aiohttp AppRunner.
+
+    The metrics show node URLs and queue internals, so only local scrapers see them unless
+    an other interface, like "0.0.0.0" for all of them, is given.
+    """
+    app = web.Application()
+    app.router.add_get("/", metrics_handler(registry))
+    app.router.add_get("/metrics", metrics_handler(registry))
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, interface, port).start()
+    return runner
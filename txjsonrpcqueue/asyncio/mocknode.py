@@ -0,0 +1,43 @@
+"""Asyncio variant of the local mock Steem JSON-RPC node"""
+import asyncio
+from aiohttp import web
+
+def mock_node_app(node):
+    """aiohttp application answering JSON-RPC batches with a core MockNode"""
+    async def handle_post(request):
+        """JSON-RPC batch"""
+        #aiohttp decodes gzip and deflate request bodies by itself.
+        status, body = node.handle(await request.read())
+        length = node.content_length(body)
+        delay = node.delay()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if length == len(body):
+            return web.Response(status=status, body=body, content_type="application/json")
+        #Truncated, drop the connection mid-body.
+        response = web.StreamResponse(status=status,
+                                      headers={"Content-Type": "application/json"})
+        response.content_length = length
+        await response.prepare(request)
+        await response.write(body)
+        request.transport.close()
+        return response
+    async def handle_get(request):
+        """The stats of the mock node"""
+        #pylint: disable=unused-argument
+        return web.json_response(node.stats)
+    app = web.Application()
+    app.router.add_post("/", handle_post)
+    app.router.add_get("/", handle_get)
+    return app
+
+async def listen_mock_node(node, port=0, interface="127.0.0.1"):
+    """Serve a MockNode on http://interface:port/ , returns a (AppRunner, port) tuple.
+
+    With port 0 a free port is picked.
+    """
+    runner = web.AppRunner(mock_node_app(node))
+    await runner.setup()
+    site = web.TCPSite(runner, interface, port)
+    await site.start()
+    return runner, runner.addresses[0][1]
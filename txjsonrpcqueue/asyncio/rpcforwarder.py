@@ -1,22 +1,132 @@
 """Asyncio RpcForwarder implementation"""
 #pylint: disable=missing-docstring
-import json
+import time
+import functools
 import asyncio
 import aiohttp
-from txjsonrpcqueue.exception import HttpServerError, HttpClientError, JsonRpcBatchError
-from txjsonrpcqueue.exception import JsonRpcCommandError, JsonRpcCommandResponseError
+from txjsonrpcqueue.exception import HttpServerError, HttpClientError, DeadlineExceeded
+from txjsonrpcqueue.core.batchsize import AdaptiveBatchSize
+from txjsonrpcqueue.core.codec import get_codec, BatchEncoder
+from txjsonrpcqueue.core.compression import Compression
+from txjsonrpcqueue.core.balancer import NodeBalancer
+from txjsonrpcqueue.core.rpcforwarder import CoreBatch, StreamingBatchParser
+from txjsonrpcqueue.core.rpcforwarder import batch_timeout, unexpired
 
+#Extra command for single command batches, encoded once
+_BOGUS_CMD = b'{"jsonrpc":"2.0","method":"bogus_api.bogus_method","params":[],"id":0}'
+
+def _read_body(response, parser):
+    """Feed the response body to a StreamingBatchParser as it arrives, returns a future
+    for the parser once the body is complete"""
+    body_future = asyncio.get_event_loop().create_future()
+    def read_chunk(chunk_future=None):
+        if chunk_future is not None:
+            try:
+                chunk = chunk_future.result()
+            #pylint: disable=broad-except
+            except Exception as exception:
+                body_future.set_exception(exception)
+                return
+            if not chunk:
+                body_future.set_result(parser)
+                return
+            parser.feed(chunk)
+        asyncio.ensure_future(response.content.readany()).add_done_callback(read_chunk)
+    read_chunk()
+    return body_future
+
+def _aio_resolve(task, result):
+    #The first response for a command wins, later ones (hedged copies) are discarded.
+    if not task.fod.done():
+        task.fod.set_result(result)
+
+def _aio_fail(task, exception):
+    if not task.fod.done():
+        task.fod.set_exception(exception)
+
+#Framework specific batch level exceptions worth a retry
+_AIO_TRANSIENT = (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError)
+
+class ConnectionPool(object):
+    """Persistent (keep-alive) HTTP connection pool, may be shared between forwarders"""
+    def __init__(self, limit_per_host=10, idle_timeout=60.0):
+        self.limit_per_host = limit_per_host
+        self.idle_timeout = idle_timeout
+        self._session = None
+    def session(self):
+        """Get the shared aiohttp.ClientSession, created on first use inside the event loop"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit_per_host=self.limit_per_host,
+                                             keepalive_timeout=self.idle_timeout)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+    def close(self):
+        """Close the session and all of its connections, returns a future"""
+        if self._session is None or self._session.closed:
+            future = asyncio.Future()
+            future.set_result(None)
+            return future
+        return asyncio.ensure_future(self._session.close())
 
 class RpcForwarder:
-    # pylint: disable=too-few-public-methods
-    def __init__(self, queue, host_injector=None, host_url=None):
+    # pylint: disable=too-few-public-methods,too-many-instance-attributes
+    def __init__(self, queue, host_injector=None, host_url=None, max_inflight=1, pool=None,
+                 batch_size=None, hedge=None, timeout=None, retry=None, codec=None, stream=True,
+                 compression=None, metrics=None, recorder=None, merger=None):
+        #pylint: disable=too-many-arguments
         if host_injector is None and host_url is None:
             raise RuntimeError("Constructor requires either host_injector or host_url to be set.")
         if host_injector and host_url:
             raise RuntimeError("Either host_injector or host_url should be specified, not both")
         self.queue = queue
-        self.cmd_id = 0
+        #Per host adaptive batch size controller, may be shared between forwarders.
+        if batch_size is None:
+            batch_size = AdaptiveBatchSize()
+        self.batch_size = batch_size
+        #Optional HedgePolicy for re-sending slow batches to a second node.
+        self.hedge = hedge
+        #Default HTTP timeout for a batch, tightened by the deadlines of its commands.
+        self.timeout = timeout
+        #Optional RetryPolicy for batches failing with a transient error.
+        self.retry = retry
+        #JSON codec for batch encoding and decoding, the fastest one installed by default.
+        if codec is None or isinstance(codec, str):
+            codec = get_codec(codec)
+        self.codec = codec
+        self.encoder = BatchEncoder(codec)
+        #Parse batch responses while they come in, resolving each command as early as possible.
+        self.stream = stream
+        #Response decompression and optional request body compression.
+        if compression is None:
+            compression = Compression()
+        self.compression = compression
+        #Optional MetricsRegistry, commands failing in our batches get counted there.
+        self.metrics = metrics
+        #Optional Recorder, appends every posted batch and its raw response to a capture file.
+        self.recorder = recorder
+        #Optional CallMerger, merges calls to list-taking methods within a batch.
+        self.merger = merger
+        self.fail = _aio_fail
+        if metrics is not None:
+            self.fail = metrics.counting_fail(_aio_fail)
+            metrics.add_queue(queue)
+            metrics.add_forwarder(self)
+            if getattr(host_injector, "fnod", None) is not None:
+                metrics.add_nodes(host_injector.fnod)
         self.started = False
+        #The number of batches we keep posted to the host at any one time.
+        self.max_inflight = max_inflight
+        #Number of running fetch/post loops
+        self.loops = 0
+        #Healthy nodes injected by the host injector, used for balancing and hedging.
+        self.balancer = NodeBalancer()
+        self.balanced = False
+        #If no (shared) connection pool is given, we own a pool sized for our inflight window,
+        # with headroom for stalled batches that got hedged to an other node.
+        self.own_pool = pool is None
+        if pool is None:
+            pool = ConnectionPool(limit_per_host=max(2 * max_inflight, 10))
+        self.pool = pool
         if host_injector:
             #Register ourselves with the host injector object. Don't start yet untill the host
             # injector injects us with an initial host.
@@ -24,149 +134,232 @@ class RpcForwarder:
         else:
             #Set our static host url and start processing batches imediately.
             self.host_url = host_url
-            self._fetch_batch()
+            self._start()
     def inject_host_url(self, url):
         #Set the host url to its new value
         self.host_url = url
         #If we weren't started yet, start fetching batches now.
         if not self.started:
+            self._start()
+    def inject_host_set(self, nodes, balanced=True):
+        """Set of healthy nodes (map from URL to speed) to hedge to, and if balanced,
+           to spread batches over"""
+        if not nodes:
+            return
+        self.balancer.set_nodes(nodes)
+        self.balanced = balanced
+        if not self.started:
+            #Start up on the fastest node of the set.
+            self.inject_host_url(min(nodes, key=nodes.get))
+        else:
+            self._spawn_loops()
+    @property
+    def maxbatch(self):
+        """Current batch size for the current host"""
+        return self.batch_size.get(self.host_url)
+    def batch_sizes(self):
+        """Current batch size for every host we posted batches to"""
+        return self.batch_size.snapshot()
+    def close(self):
+        """Close the connection pool if we own it, returns a future"""
+        if self.own_pool:
+            return self.pool.close()
+        future = asyncio.Future()
+        future.set_result(None)
+        return future
+    def _start(self):
+        self.started = True
+        self._spawn_loops()
+    def _target_loops(self):
+        #max_inflight batches per healthy node when balancing, or for the single host.
+        if self.balanced:
+            return self.max_inflight * max(len(self.balancer), 1)
+        return self.max_inflight
+    def _spawn_loops(self):
+        #Start independent fetch/post loops up to the target. Each loop fetches its next batch
+        # as soon as its previous batch completed, so up to max_inflight batches are
+        # posted to a host at any one time. Command ids are numbered per batch, they only
+        # need to be unique within the batch, so loops don't share any id state.
+        while self.loops < self._target_loops():
+            self.loops += 1
             self._fetch_batch()
-    def _process_batch(self, batch_fut):
-        #Map from JSON-RPC to future waiting for result
-        futures_map = dict()
-        #The outgoing JSON-RPC batch
-        batch_out = list()
-        #Set of unprocessed entries
-        unprocessed = set()
-        #Start a new session (may want to look into reusing strategy here)
-        session = aiohttp.ClientSession()
+    def _pick_host(self):
+        #Spread batches over the healthy node set if we are balancing, else use the single host
+        # unless it just failed and there is an other healthy node to fail over to.
+        if self.balanced:
+            node = self.balancer.pick()
+        elif self.balancer.is_penalized(self._host()):
+            node = self.balancer.pick(exclude=self._host())
+        else:
+            node = None
+        if node is None:
+            return self._host()
+        return node
+    def _host(self):
+        return self.host_url
+    def _retry(self, batch, host, exception):
+        """Requeue commands of a batch that failed with a transient error, after a backoff"""
+        if self.retry is None or batch.pending != 1 or \
+                not self.retry.transient(exception, _AIO_TRANSIENT):
+            return
+        tasks = self.retry.take(batch)
+        if tasks:
+            #Avoid the failing host for a while, so the retry can go to an other healthy node.
+            self.balancer.penalize(host, self.retry.penalty)
+            asyncio.get_event_loop().call_later(self.retry.delay(tasks),
+                                                self.queue.json_rpcqueue_again, tasks)
+    def _post(self, batch, batch_in, host, body, encoding=None):
+        """Post one copy of the batch to a host"""
+        #pylint: disable=too-many-arguments
+        start_time = time.time()
+        #The request task, then the response once it is in, stopped if the copy loses.
+        waiting = dict()
+        def cancel():
+            #An other copy of the batch completed it first.
+            waiting["lost"] = True
+            if "response" in waiting:
+                waiting["response"].close()
+            else:
+                waiting["request"].cancel()
+        batch.posted(cancel)
+        self.balancer.start(host)
+        timeout, by_deadline = batch_timeout(batch_in, self.timeout)
+        def to_exception(exception):
+            if isinstance(exception, asyncio.TimeoutError):
+                #Batch timed out, requeue commands that still have time left. Only the
+                # forwarder timeout says anything about the node being overloaded.
+                if not by_deadline:
+                    self.batch_size.overload(host)
+                if batch.pending == 1:
+                    self.queue.json_rpcqueue_again(batch.take_unprocessed(
+                        lambda task: unexpired(task, by_deadline)))
+                return DeadlineExceeded("Batch timeout exceeded")
+            return exception
         def process_response(response):
-            code = 200
-            def process_batch_level_exception(exception):
-                """Spread batch level exception to each of the batch entries"""
-                #On a batch level exception, forward the cought exception to the future for
-                # each of the commands that are part of the batch.
-                #pylint: disable=unused-variable
-                for key, entry_future in futures_map.items():
-                    entry_future.set_exception(exception)
-            def process_json_parse_error(code, body):
-                """Convert a json parse error and HTTP error code into appropriate exception type"""
-                if code > 499: #5xx server side error codes
-                    process_batch_level_exception(HttpServerError(code, body))
-                else:
-                    if code > 399: #4xx client side errors.
-                        process_batch_level_exception(
-                            HttpClientError(code, body))
-                    else:
-                        # Non-error code in the 2xx and 3xx range.
-                        process_batch_level_exception(
-                            JsonRpcBatchError(code, body,
-                                              "Invalid JSON returned by server"))
-            def close_session(session):
-                """Asynchonically close the session"""
-                def on_closed(result):
-                    #pylint: disable=broad-except
-                    try:
-                        result.result()
-                    except Exception:
-                        pass
-                close_future = asyncio.ensure_future(session.close())
-                close_future.add_done_callback(on_closed)
-            def process_body(text_result):
-                """Process JSON-RPC batch response body"""
-                def process_response_json(resp_json):
-                    """Process JSON-RPC batch response body JSON content."""
-                    #pylint: disable=broad-except
-                    try:
-                        #Parse the JSON content of the JSON-RPC batch response.
-                        resp_obj = json.loads(resp_json)
-                    except json.decoder.JSONDecodeError:
-                        process_json_parse_error(code, resp_json)
-                        resp_obj = []
-                    #Assert the parsed JSON is a list.
-                    if not isinstance(resp_obj, list):
-                        process_batch_level_exception(
-                            JsonRpcBatchError(code, resp_json,
-                                              "Non-batch JSON response from server."))
-                        resp_obj = []
-                    #Process the individual command responses
-                    for response in resp_obj:
-                        #Get the id from the response to match with the apropriate reuest
-                        if "id" in response and response["id"] in unprocessed:
-                            query_id = response["id"]
-                            #Maintain list of unprocessed id's
-                            unprocessed.remove(query_id)
-                            #Look up the proper command future to map this response to.
-                            query_future = futures_map[query_id]
-                            #Distinguish between responses and errors.
-                            if "result" in response:
-                                #Set future result
-                                query_future.set_result(response["result"])
-                            if (not "result" in response) and "error" in response and \
-                                    "message" in response["error"] and \
-                                    "code" in response["error"] and \
-                                    "data" in response["error"]:
-                                query_future.set_exception(
-                                    JsonRpcCommandError(response["error"]["code"],
-                                                        response["error"]["message"],
-                                                        response["error"]["data"]))
-                            if (not "result" in response) and (not "error" in response):
-                                query_future.set_exception(
-                                    JsonRpcCommandResponseError(
-                                        "Bad command response from server", response))
-                    #Work through any request item id not found in the response.
-                    if resp_obj:
-                        for no_valid_response_id in unprocessed:
-                            query_future = futures_map[no_valid_response_id]
-                            error = JsonRpcCommandResponseError(
-                                "Request command id not found in response.", resp_obj)
-                            query_future.set_exception(error)
+            def process_body(body_future):
+                """Process the end of the JSON-RPC batch response body"""
+                self.balancer.done(host)
                 try:
-                    text = text_result.result()
-                    process_response_json(text)
+                    parser = body_future.result()
                 #pylint: disable=broad-except
                 except Exception as exception:
-                    process_batch_level_exception(exception)
-                close_session(session)
-                self._fetch_batch()
-            #Get (text) content from the server response
+                    if "lost" in waiting:
+                        batch.copy_done()
+                        return
+                    exception = to_exception(exception)
+                    if self.recorder is not None:
+                        self.recorder.record(host, start_time, time.time() - start_time, body,
+                                             code, encoding=encoding, error=exception)
+                    if self.metrics is not None:
+                        self.metrics.batch_error(host, exception)
+                    self._retry(batch, host, exception)
+                    batch.copy_done(None, exception)
+                    return
+                latency = time.time() - start_time
+                if self.hedge is not None:
+                    self.hedge.record(latency)
+                resp_obj, exception = parser.finish()
+                if self.recorder is not None:
+                    self.recorder.record(host, start_time, latency, body, code,
+                                         parser.raw_body(), encoding)
+                if self.metrics is not None:
+                    self.metrics.latency(host, latency)
+                    if exception is not None:
+                        self.metrics.batch_error(host, exception)
+                if isinstance(exception, HttpServerError):
+                    self.batch_size.overload(host)
+                if isinstance(exception, HttpClientError) and code == 413 and \
+                        batch.size > 1 and batch.pending == 1:
+                    #Batch too large for the node, shrink batch size and requeue.
+                    self.batch_size.overload(host)
+                    self.queue.json_rpcqueue_again(batch.take_unprocessed())
+                if exception is None:
+                    self.batch_size.success(host, len(batch_in), latency, parser.size)
+                else:
+                    self._retry(batch, host, exception)
+                batch.copy_done(resp_obj, exception)
+            if response.cancelled():
+                self.balancer.done(host)
+                batch.copy_done()
+                return
+            #Resolve commands as their responses come in, the rest once the body is complete.
             try:
                 result = response.result()
+                waiting["response"] = result
                 code = result.status
-                txt = asyncio.ensure_future(result.text())
-                txt.add_done_callback(process_body)
+                if self.metrics is not None:
+                    self.metrics.status(host, code)
+                _read_body(result, StreamingBatchParser(
+                    code, batch.process_response, self.codec.loads, self.stream,
+                    self.recorder is not None)).add_done_callback(process_body)
             #pylint: disable=broad-except
             except Exception as exception:
-                #If the batch JSON-RPC call went wrong, process the batch level exception,
-                # close the session and move on to fetching the next batch.
-                process_batch_level_exception(exception)
-                close_session(session)
-                self._fetch_batch()
+                #If the batch JSON-RPC call went wrong, process the batch level exception.
+                self.balancer.done(host)
+                exception = to_exception(exception)
+                if self.recorder is not None:
+                    self.recorder.record(host, start_time, time.time() - start_time, body,
+                                         encoding=encoding, error=exception)
+                if self.metrics is not None:
+                    self.metrics.batch_error(host, exception)
+                if not isinstance(exception, DeadlineExceeded):
+                    self.batch_size.overload(host)
+                self._retry(batch, host, exception)
+                batch.copy_done(None, exception)
+        #aiohttp negotiates gzip and deflate (and brotli if installed) responses by itself.
+        headers = {"Content-Type": "application/json"}
+        if not self.compression.accept:
+            headers["Accept-Encoding"] = "identity"
+        if encoding is not None:
+            headers["Content-Encoding"] = encoding
+        #Post the JSON-RPC batch request to the server and wait for response
+        resp = asyncio.ensure_future(self.pool.session().post(
+            host, data=body, headers=headers, timeout=aiohttp.ClientTimeout(total=timeout)))
+        waiting["request"] = resp
+        resp.add_done_callback(process_response)
+    def _hedge_batch(self, batch, batch_in, host, body, encoding=None):
+        """Re-send a batch that is still outstanding to the next-best node"""
+        #pylint: disable=too-many-arguments
+        if batch.completed:
+            return
+        alternate = self.balancer.pick(exclude=host)
+        if alternate is None:
+            return
+        self.hedge.hedged += 1
+        self._post(batch, batch_in, alternate, body, encoding)
+    def _process_batch(self, host, batch_fut):
+        maxbatch = self.batch_size.get(host)
         #Get the input batch from our invocation argument
         batch_in = batch_fut.result()
-        #Build the output batch and futures map.
-        for cmd in batch_in:
-            self.cmd_id += 1
-            unprocessed.add(self.cmd_id)
-            newcmd = dict()
-            newcmd["id"] = self.cmd_id
-            newcmd["jsonrpc"] = "2.0"
-            newcmd["method"] = cmd["method"]
-            newcmd["params"] = cmd["params"]
-            futures_map[self.cmd_id] = cmd["future"]
-            batch_out.append(newcmd)
+        #Drop commands cancelled or expired since the queue handed them out.
+        batch_in = [cmd for cmd in batch_in if not cmd.fod.done()]
+        if not batch_in:
+            self._fetch_batch()
+            return
+        batch_out = batch_in if self.merger is None else self.merger.merge(batch_in)
+        #Map from JSON-RPC id, numbered from one within the batch, to task waiting for result
+        tasks = dict(enumerate(batch_out, 1))
         #Piggybag extra command onto single command batches. FIXME: this is a temporary workaround.
-        if len(batch_out) == 1:
-            newcmd = dict()
-            newcmd["id"] = 0
-            newcmd["jsonrpc"] = "2.0"
-            newcmd["method"] = "bogus_api.bogus_method"
-            newcmd["params"] = []
-            batch_out.append(newcmd)
-        #Post the JSON-RPC batch request to the server and wait for response
-        resp = asyncio.ensure_future(session.post(self.host_url, json=batch_out))
-        resp.add_done_callback(process_response)
+        # Not once the batch size for the host dropped to one, the node may refuse two commands.
+        extra = _BOGUS_CMD if len(batch_out) == 1 and maxbatch > 1 else None
+        body, encoding = self.compression.encode(self.encoder.encode(batch_out, extra=extra))
+        if self.metrics is not None:
+            self.metrics.batch(len(batch_out))
+        #Once every command has its response (from any copy), this loop fetches its next batch.
+        batch = CoreBatch(tasks, _aio_resolve, self.fail, self._fetch_batch, self.merger,
+                          self.queue.json_rpcqueue_again, extra is not None)
+        self._post(batch, batch_in, host, body, encoding)
+        if self.hedge is not None:
+            delay = self.hedge.delay()
+            if delay is not None:
+                batch.later(asyncio.get_event_loop().call_later(
+                    delay, self._hedge_batch, batch, batch_in, host, body, encoding).cancel)
     def _fetch_batch(self):
+        if self.loops > self._target_loops():
+            #The healthy node set shrunk, let this loop end.
+            self.loops -= 1
+            return
+        host = self._pick_host()
         #Notify the queue that we are ready to receive a batch.
-        batch_future = self.queue.json_rpcqueue_get()
-        batch_future.add_done_callback(self._process_batch)
+        batch_future = self.queue.json_rpcqueue_get(self.batch_size.get(host))
+        batch_future.add_done_callback(functools.partial(self._process_batch, host))
@@ -1,2 +1,3 @@
 """Asyncio implementations of STEEM specific classes"""
 from txjsonrpcqueue.asyncio.steem.injector import EmbeddedHealthHostInjector
+from txjsonrpcqueue.asyncio.steem.streamer import BlockStreamer
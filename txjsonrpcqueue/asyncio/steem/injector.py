@@ -10,16 +10,19 @@ from txjsonrpcqueue.core.steem import MonitorSet, FastestNode
 
 class EmbeddedHealthHostInjector(object):
     """Injector Class that momitors all known STEEM nodes for response times,
-       and picks the fastest one"""
-    def __init__(self, start_node):
+       and picks the fastest one, or in balanced mode spreads load over all healthy nodes"""
+    def __init__(self, start_node, balanced=False):
         portable = Portable() #Helper object for making portable code easyer.
+        #The healthy node set is always injected, for hedging, and if balanced, for balancing.
+        self.balanced = balanced
+        inject_set = self._update_set
         if isinstance(start_node, list):
             #We accept a list of URLs as start node
-            self.fnod = FastestNode(start_node[0], self._update_fastest)
+            self.fnod = FastestNode(start_node[0], self._update_fastest, inject_set)
             self.monitorset = MonitorSet(start_node, self.fnod, portable)
         else:
             #We also accept a single string.
-            self.fnod = FastestNode(start_node, self._update_fastest)
+            self.fnod = FastestNode(start_node, self._update_fastest, inject_set)
             self.monitorset = MonitorSet([start_node], self.fnod, portable)
         self.forwarders = set()
     def register_forwarder(self, forwarder):
@@ -31,3 +34,8 @@ class EmbeddedHealthHostInjector(object):
     def _update_fastest(self, fastest):
         for forwarder in self.forwarders:
             forwarder.inject_host_url(fastest)
+    def _update_set(self, nodes):
+        for forwarder in self.forwarders:
+            #Forwarders that don't know about node sets only get the fastest node injected.
+            if hasattr(forwarder, "inject_host_set"):
+                forwarder.inject_host_set(nodes, self.balanced)
@@ -0,0 +1,47 @@
+"""Asyncio implementation of the prefetching block streamer"""
+import asyncio
+from collections import deque
+from txjsonrpcqueue.asyncio import Portable
+from txjsonrpcqueue.core.steem.streamer import CoreBlockStreamer
+
+class BlockStreamer(object):
+    """Async iterator over (block number, block) tuples from a WildcardQueue, in order.
+
+    Follows the chain head if end is None, otherwise stops after block end.
+    """
+    #pylint: disable=too-many-arguments
+    def __init__(self, queue, start, end=None, window=100, poll_interval=3.0,
+                 irreversible=False, on_error=None):
+        self.blocks = deque()
+        self.waiter = None
+        self.started = False
+        self.finished = False
+        self.core = CoreBlockStreamer(Portable(), queue, self._on_block, start, end, window,
+                                      poll_interval, irreversible, on_error, self._on_done)
+    def __aiter__(self):
+        return self
+    async def __anext__(self):
+        if not self.started:
+            self.started = True
+            self.core.start()
+        while not self.blocks:
+            if self.finished:
+                raise StopAsyncIteration
+            self.waiter = asyncio.Future()
+            await self.waiter
+        rval = self.blocks.popleft()
+        self.core.release()
+        return rval
+    def stop(self):
+        """Stop streaming, the iterator ends after the blocks already delivered"""
+        self.core.stop()
+        self._on_done()
+    def _wake(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+    def _on_block(self, block_num, block):
+        self.blocks.append((block_num, block))
+        self._wake()
+    def _on_done(self):
+        self.finished = True
+        self._wake()
@@ -1,7 +1,11 @@
 """Asyncio  WildcardQue implementation"""
 #pylint: disable=missing-docstring
+import time
 import asyncio
-from txjsonrpcqueue.core.wildcardqueue import WildcardMethod, CoreWildcardQueue
+from txjsonrpcqueue.core.wildcardqueue import WildcardMethod, CoreWildcardQueue, CoreLaneQueue
+from txjsonrpcqueue.core.wildcardqueue import CoreBulk, Task, bulk_caller
+from txjsonrpcqueue.core.codec import get_codec
+from txjsonrpcqueue.exception import DeadlineExceeded
 
 class _AioFutureWrapper(object):
     #pylint: disable=too-few-public-methods
@@ -17,24 +21,215 @@ class _AioSoon(object):
     def __call__(self, callback, argument):
         asyncio.get_event_loop().call_later(0.0, callback, argument)
 
-def _aio_set_future(dct):
-    dct["future"] = asyncio.Future()
+class _QueuedFuture(asyncio.Future):
+    """Future of a queued call, cancelling it lets the queue drop the call"""
+    #pylint: disable=too-few-public-methods
+    __slots__ = ("canceller",)
+    def cancel(self, *args, **kwargs):
+        if not super().cancel(*args, **kwargs):
+            return False
+        if self.canceller is not None:
+            self.canceller(self)
+        return True
+
+def _aio_canceller(core, lane=None):
+    """Canceller for the futures of queued calls, called after the future was cancelled"""
+    def cancel(future):
+        #pylint: disable=unused-argument
+        core.abandon(lane)
+    return cancel
+
+class _AioFutureOps(object):
+    """Asyncio (future) implementation of the task operations WildcardMethod needs"""
+    #pylint: disable=no-self-use
+    def set(self, ttask, canceller=None):
+        ttask.fod = _QueuedFuture()
+        ttask.fod.canceller = canceller
+    def get(self, ttask):
+        return ttask.fod
+    def set_error(self, ttask, err):
+        ttask.fod.set_exception(err)
+    def follow(self, ttask, done=None, deadline=None):
+        """Create a future that follows the result of the (coalesced) future in ttask,
+           failing with DeadlineExceeded if still unresolved after deadline seconds"""
+        if ttask.followers is None:
+            #First follower, the future in ttask becomes internal and dispatches to followers.
+            ttask.followers = list()
+            def on_done(future):
+                done()
+                for follower in ttask.followers:
+                    if not follower.done():
+                        if future.cancelled():
+                            follower.cancel()
+                        elif future.exception() is not None:
+                            follower.set_exception(future.exception())
+                        else:
+                            follower.set_result(future.result())
+            ttask.fod.add_done_callback(on_done)
+        def on_follower_done(follower):
+            #pylint: disable=unused-argument
+            #The last caller waiting for the command gave up, so cancel the command itself.
+            if not ttask.fod.done() and all(other.done() for other in ttask.followers):
+                ttask.fod.cancel()
+        follower = asyncio.Future()
+        follower.add_done_callback(on_follower_done)
+        ttask.followers.append(follower)
+        if deadline is not None:
+            def expire():
+                if not follower.done():
+                    follower.set_exception(DeadlineExceeded("Command deadline exceeded"))
+            timer = asyncio.get_event_loop().call_later(deadline, expire)
+            follower.add_done_callback(lambda future: timer.cancel())
+        return follower
+    def resolved(self, result):
+        future = asyncio.Future()
+        future.set_result(result)
+        return future
+    def watch(self, ttask, on_result):
+        """Let on_result see the result of the future in ttask"""
+        def on_done(future):
+            if not future.cancelled() and future.exception() is None:
+                on_result(future.result())
+        ttask.fod.add_done_callback(on_done)
+    def expire_later(self, ttask, seconds, abandon, parked=False):
+        """Fail the future in ttask with DeadlineExceeded if still unresolved after seconds,
+           with parked set fail it with BufferError if still parked in the queue"""
+        def expire():
+            if ttask.fod.done() or (parked and not ttask.parked):
+                return
+            if parked:
+                ttask.fod.set_exception(BufferError("No room in WildcardQueue within max wait"))
+            else:
+                ttask.fod.set_exception(DeadlineExceeded("Command deadline exceeded"))
+            abandon(ttask.lane)
+        timer = asyncio.get_event_loop().call_later(seconds, expire)
+        ttask.fod.add_done_callback(lambda future: timer.cancel())
+    def wake(self, ttask):
+        """Resolve the future of a room waiter"""
+        if not ttask.fod.done():
+            ttask.fod.set_result(None)
+    def skip(self, ttask):
+        """Check if a queued task should no longer be sent, failing it if it expired"""
+        if ttask.fod.done():
+            return True
+        if ttask.deadline is not None and ttask.deadline <= time.time():
+            ttask.fod.set_exception(DeadlineExceeded("Command deadline exceeded"))
+            return True
+        return False
+
+_AIO_OPS = _AioFutureOps()
+
+class Bulk(object):
+    """Async iterator over the results of a bulk call, in input order.
 
-def _aio_set_error(dct, err):
-    dct["future"].set_exception(err)
+    Leaving an async for loop early does not stop the bulk call, use it as an async
+    context manager or call aclose to cancel the commands still outstanding.
+    """
+    def __init__(self, core, return_exceptions=False):
+        self.core = core
+        self.return_exceptions = return_exceptions
+    def __aiter__(self):
+        return self
+    async def __anext__(self):
+        future = self.core.next()
+        if future is None:
+            raise StopAsyncIteration
+        try:
+            return await future
+        except asyncio.CancelledError:
+            self.cancel()
+            raise
+        except Exception as exception: #pylint: disable=broad-except
+            if not self.return_exceptions:
+                self.cancel()
+                raise
+            return exception
+    async def __aenter__(self):
+        return self
+    async def __aexit__(self, exc_type, exc, traceback):
+        self.cancel()
+    async def aclose(self):
+        """Stop the bulk call, see cancel"""
+        self.cancel()
+    def cancel(self):
+        """Stop the bulk call, cancelling the commands whose results were not consumed"""
+        for future in self.core.close():
+            future.cancel()
 
 class WildcardQueue(object):
     # pylint: disable=too-few-public-methods
     """Asyncio based hysteresis queue wrapper"""
-    def __init__(self, low=8000, high=10000, highwater=None, lowwater=None, namespace=None):
+    def __init__(self, low=8000, high=10000, highwater=None, lowwater=None, namespace=None,
+                 coalesce=False, cache=None, default_deadline=None, lanes=None,
+                 lane_weights=None, lane_watermarks=None, namespace_lanes=None, codec=None,
+                 backpressure=False, max_wait=None):
         #pylint: disable=too-many-arguments
+        #Cached WildcardMethod objects by namespace or method name
+        self.proxies = dict()
         self.namespace = namespace
-        self.core = CoreWildcardQueue(_AioSoon(), low, high, highwater, lowwater)
+        #Map of identical queued or in-flight calls, if coalescing is enabled.
+        self.coalesced = dict() if coalesce else None
+        #Optional ResponseCache in front of the queue.
+        self.cache = cache
+        #Deadline in seconds for calls that don't specify a _deadline themselves.
+        self.default_deadline = default_deadline
+        #Map from namespace or full method name to priority lane.
+        self.namespace_lanes = namespace_lanes
+        #Params get JSON encoded when queued, with the fastest codec installed by default.
+        if codec is None or isinstance(codec, str):
+            codec = get_codec(codec)
+        self.dumps = codec.dumps
+        #With backpressure calls to a full queue wait for room, for at most max_wait seconds.
+        self.max_wait = max_wait
+        if lanes:
+            #Priority lanes, highest priority first, each with its own hysteresis.
+            self.core = CoreLaneQueue(_AioSoon(), lanes, low, high, highwater, lowwater, _AIO_OPS.skip,
+                                      lane_weights, lane_watermarks, backpressure, _AIO_OPS.wake)
+        else:
+            self.core = CoreWildcardQueue(_AioSoon(), low, high, highwater, lowwater, _AIO_OPS.skip,
+                                          backpressure, _AIO_OPS.wake)
+        self.canceller = _aio_canceller(self.core)
+        #Cancellers by lane, so a cancelled call only counts for its own lane
+        self.cancellers = dict((lane, _aio_canceller(self.core, lane)) for lane in lanes or ())
     def json_rpcqueue_get(self, maxbatch=10):
         """Fetch an entry from the queue, imediately if possible, or remember
            callback for when an entry becomes available."""
         future_get = asyncio.Future()
         self.core.get(_AioFutureWrapper(future_get), maxbatch)
         return future_get
+    def json_rpcqueue_again(self, batch):
+        self.core.again(batch)
+    def bulk(self, method, params_iterable, window=100, return_exceptions=False):
+        """Call method once for every item of params_iterable, with at most window calls
+           in the queue or in flight. Returns an async iterator over the results in input
+           order. A failed call raises at its position and cancels the rest, unless
+           return_exceptions is set, then the exception is yielded as its result. Use
+           the iterator as async context manager to cancel the rest on leaving early."""
+        return Bulk(CoreBulk(bulk_caller(self, method), params_iterable, window),
+                    return_exceptions)
+    def room(self, lane=None, max_wait=None):
+        """Future that completes once the queue, or lane, takes calls again. Producers
+           waiting for room are woken in FIFO order, after the calls parked before them
+           by a queue with backpressure. Fails with BufferError after max_wait seconds,
+           the max_wait of the queue by default."""
+        waiter = Task(None, None, lane)
+        _AIO_OPS.set(waiter, self.cancellers.get(lane, self.canceller))
+        if max_wait is None:
+            max_wait = self.max_wait
+        if max_wait is not None:
+            _AIO_OPS.expire_later(waiter, max_wait, self.core.abandon, True)
+        self.core.room(waiter)
+        return waiter.fod
+    def proxy(self, outername):
+        """The cached WildcardMethod for a namespace or a method in the default namespace"""
+        proxy = self.proxies.get(outername)
+        if proxy is None:
+            proxy = self.proxies[outername] = WildcardMethod(outername, self, _AIO_OPS)
+        return proxy
     def __getattr__(self, outername):
-        return WildcardMethod(outername, self, _aio_set_future, _aio_set_error)
+        if outername.startswith("__"):
+            raise AttributeError(outername)
+        proxy = self.proxy(outername)
+        #Later lookups of outername find the proxy without calling __getattr__.
+        self.__dict__[outername] = proxy
+        return proxy
@@ -2,4 +2,15 @@
 """Core implementations. DON'T USE if you are a user of this lib.
 Only meant for implementation classes not part of the API.
 """
-from txjsonrpcqueue.core.wildcardqueue import CoreWildcardQueue
+from txjsonrpcqueue.core.wildcardqueue import CoreWildcardQueue, CoreLaneQueue, Task
+from txjsonrpcqueue.core.batchsize import AdaptiveBatchSize
+from txjsonrpcqueue.core.cache import ResponseCache
+from txjsonrpcqueue.core.balancer import NodeBalancer
+from txjsonrpcqueue.core.hedge import HedgePolicy
+from txjsonrpcqueue.core.retry import RetryPolicy
+from txjsonrpcqueue.core.merge import CallMerger, MergeRule
+from txjsonrpcqueue.core.codec import JsonCodec, BatchEncoder, get_codec, available_codecs
+from txjsonrpcqueue.core.compression import Compression
+from txjsonrpcqueue.core.metrics import MetricsRegistry
+from txjsonrpcqueue.core.mocknode import MockNode, synthetic_block
+from txjsonrpcqueue.core.recorder import Recorder, ReplayNode, read_recording
@@ -0,0 +1,44 @@
+"""Multi node load balancing shared by the asyncio and twisted RpcForwarder"""
+import random
+import time
+
+class NodeBalancer(object):
+    """Power-of-two-choices balancer weighted by node latency and outstanding batches"""
+    def __init__(self):
+        self.speeds = dict()
+        self.outstanding = dict()
+        self.penalized = dict()
+    def set_nodes(self, speeds):
+        """Replace the set of healthy nodes, speeds is a map from node URL to latency"""
+        self.speeds = dict(speeds)
+        for node in self.speeds:
+            self.outstanding.setdefault(node, 0)
+    def __len__(self):
+        return len(self.speeds)
+    def _score(self, node):
+        #Expected wait: the latency of the node times the batches already queued on it.
+        return self.speeds[node] * (self.outstanding.get(node, 0) + 1)
+    def penalize(self, node, seconds):
+        """Avoid a node that just failed for a while"""
+        self.penalized[node] = time.time() + seconds
+    def is_penalized(self, node):
+        """Check if a node is currently being avoided"""
+        return self.penalized.get(node, 0.0) > time.time()
+    def pick(self, exclude=None):
+        """Pick a node: the better of two random healthy nodes, or None if there are none"""
+        nodes = [node for node in self.speeds
+                 if node != exclude and not self.is_penalized(node)]
+        if not nodes:
+            return None
+        if len(nodes) == 1:
+            return nodes[0]
+        first, second = random.sample(nodes, 2)
+        if self._score(second) < self._score(first):
+            return second
+        return first
+    def start(self, node):
+        """A batch was posted to node"""
+        self.outstanding[node] = self.outstanding.get(node, 0) + 1
+    def done(self, node):
+        """A batch posted to node completed"""
+        self.outstanding[node] = max(self.outstanding.get(node, 0) - 1, 0)
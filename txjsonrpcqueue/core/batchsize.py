@@ -0,0 +1,57 @@
+"""Adaptive (AIMD) batch size controller shared by the asyncio and twisted RpcForwarder"""
+import time
+
+class AdaptiveBatchSize(object):
+    """Per host additive-increase/multiplicative-decrease batch size controller.
+
+    Batch size grows while batches come back within the latency and response size
+    targets, and is cut back on 413, 5xx, timeouts and connection errors.
+    """
+    #pylint: disable=too-many-instance-attributes
+    def __init__(self, initial=10, minimum=1, maximum=100, target_latency=2.0,
+                 max_response_size=8*1024*1024, increase=2, decrease=0.5, recovery=60.0):
+        #pylint: disable=too-many-arguments
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.max_response_size = max_response_size
+        self.increase = increase
+        self.decrease = decrease
+        self.recovery = recovery
+        self.sizes = dict()
+        self.slow_start = dict()
+        self.backoff_time = dict()
+    def get(self, host):
+        """Get the current batch size for a host"""
+        size = self.sizes.get(host, self.initial)
+        if size < self.initial and \
+                time.time() - self.backoff_time.get(host, 0.0) > self.recovery:
+            #Long enough since the last back-off, don't keep punishing an idle host.
+            size = self.initial
+            self.sizes[host] = size
+        return int(size)
+    def success(self, host, batch_len, latency, response_size):
+        """Register a successfully completed batch for a host"""
+        size = self.sizes.get(host, self.initial)
+        if latency > self.target_latency or response_size > self.max_response_size:
+            #Batch was too slow or too big, multiplicative decrease.
+            self._decrease(host, size)
+        elif batch_len >= int(size):
+            #Only grow if the batch actually used the full batch size.
+            if self.slow_start.get(host, True):
+                #Double untill the first back-off, then grow additively.
+                size = size * 2
+            else:
+                size = size + self.increase
+            self.sizes[host] = min(size, self.maximum)
+    def overload(self, host):
+        """Register a 413, 5xx, timeout or connection error for a host"""
+        self._decrease(host, self.sizes.get(host, self.initial))
+    def snapshot(self):
+        """Current batch size for every host seen so far"""
+        return dict((host, int(size)) for host, size in self.sizes.items())
+    def _decrease(self, host, size):
+        self.slow_start[host] = False
+        self.backoff_time[host] = time.time()
+        self.sizes[host] = max(size * self.decrease, self.minimum)
@@ -0,0 +1,95 @@
+"""Response cache shared by the asyncio and twisted WildcardQueue"""
+import time
+from collections import OrderedDict
+
+#Policy per method: IMMUTABLE results are kept untill evicted, a number is a TTL in seconds.
+# Methods not listed are never cached.
+IMMUTABLE = None
+DEFAULT_POLICIES = {
+    "block_api.get_block": IMMUTABLE,
+    "block_api.get_block_header": IMMUTABLE,
+    "condenser_api.get_block": IMMUTABLE,
+    "condenser_api.get_block_header": IMMUTABLE,
+    "condenser_api.get_ops_in_block": IMMUTABLE,
+    "account_history_api.get_ops_in_block": IMMUTABLE,
+    "condenser_api.get_transaction": IMMUTABLE,
+    "account_history_api.get_transaction": IMMUTABLE,
+    "condenser_api.get_dynamic_global_properties": 1.0,
+    "database_api.get_dynamic_global_properties": 1.0,
+    "condenser_api.get_config": 300.0,
+    "database_api.get_config": 300.0,
+    "condenser_api.get_version": 300.0,
+    "database_api.get_version": 300.0,
+}
+
+def _block_num(params, result):
+    """Find the block number an 'immutable' result belongs to, or None"""
+    if isinstance(result, dict) and isinstance(result.get("block_num"), int):
+        return result["block_num"]
+    if isinstance(params, dict):
+        return params.get("block_num")
+    if params and isinstance(params[0], int):
+        return params[0]
+    return None
+
+class ResponseCache(object):
+    """Bounded LRU cache for JSON-RPC results with per method policies.
+
+    Results of IMMUTABLE methods only stay cached for good once their block is known
+    to be irreversible. The last irreversible block number is picked up from any
+    get_dynamic_global_properties result that passes through the cache; untill then
+    such results are cached for reversible_ttl seconds only. Cached results are shared
+    between callers and should not be modified.
+    """
+    #pylint: disable=too-many-instance-attributes
+    def __init__(self, maxsize=10000, policies=None, reversible_ttl=3.0):
+        self.maxsize = maxsize
+        self.policies = dict(DEFAULT_POLICIES)
+        if policies:
+            self.policies.update(policies)
+        self.reversible_ttl = reversible_ttl
+        self.last_irreversible = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    def cacheable(self, method):
+        """Check if results for this method may be cached at all"""
+        return method in self.policies
+    def lookup(self, key):
+        """Look up a key, returns a (hit, result) tuple"""
+        try:
+            expires, result = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return False, None
+        if expires is not None and expires < time.time():
+            del self.entries[key]
+            self.misses += 1
+            return False, None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return True, result
+    def store(self, key, params, result):
+        """Store a result for a key as returned by coalesce_key"""
+        method = key[0]
+        if isinstance(result, dict) and "last_irreversible_block_num" in result:
+            self.last_irreversible = max(self.last_irreversible,
+                                         result["last_irreversible_block_num"])
+        if not result:
+            #Empty results (blocks or transactions not there yet) are never cached.
+            return
+        ttl = self.policies[method]
+        if ttl is IMMUTABLE:
+            block_num = _block_num(params, result)
+            if block_num is None or block_num > self.last_irreversible:
+                ttl = self.reversible_ttl
+        self.entries[key] = (None if ttl is None else time.time() + ttl, result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+    def stats(self):
+        """Hit/miss counters and current size"""
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "size": len(self.entries)}
@@ -0,0 +1,109 @@
+"""Pluggable JSON codec used by the asyncio and twisted RpcForwarder.
+
+Uses orjson, ujson or rapidjson when installed and falls back to the stdlib json
+module. All of these raise a ValueError subclass on invalid JSON, so error
+classification into JsonRpcBatchError and friends is the same for every codec.
+"""
+import json
+
+class JsonCodec(object):
+    """JSON codec: dumps returns bytes, loads accepts bytes or str"""
+    #pylint: disable=too-few-public-methods
+    def __init__(self, name, dumps, loads):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+
+def _stdlib_codec():
+    return JsonCodec("json", lambda obj: json.dumps(obj).encode("utf8"), json.loads)
+
+def _orjson_codec():
+    import orjson #pylint: disable=import-error
+    return JsonCodec("orjson", orjson.dumps, orjson.loads)
+
+def _ujson_codec():
+    import ujson #pylint: disable=import-error
+    return JsonCodec("ujson", lambda obj: ujson.dumps(obj).encode("utf8"), ujson.loads)
+
+def _rapidjson_codec():
+    import rapidjson #pylint: disable=import-error
+    return JsonCodec("rapidjson", lambda obj: rapidjson.dumps(obj).encode("utf8"),
+                     rapidjson.loads)
+
+_CODECS = [("orjson", _orjson_codec), ("ujson", _ujson_codec),
+           ("rapidjson", _rapidjson_codec), ("json", _stdlib_codec)]
+
+def available_codecs():
+    """Names of the JSON codecs that can be used here, fastest first"""
+    names = list()
+    for name, factory in _CODECS:
+        try:
+            factory()
+            names.append(name)
+        except ImportError:
+            pass
+    return names
+
+def get_codec(name=None):
+    """Get a named JSON codec, or the fastest one installed if no name is given"""
+    for codec_name, factory in _CODECS:
+        if name is None or name == codec_name:
+            try:
+                return factory()
+            except ImportError:
+                if name is not None:
+                    raise
+    raise ValueError("Unknown JSON codec: " + str(name))
+
+def encode_params(dumps, params):
+    """The ',"params":...' fragment of a command, as kept in Task.encoded"""
+    #The concatenation is a right-sized copy, orjson output may have a lot of spare room.
+    return b',"params":' + dumps(params)
+
+class BatchEncoder(object):
+    """Assembles JSON-RPC batch request bodies from byte fragments.
+
+    The '{"jsonrpc":"2.0","method":...' prefix is encoded once per method and the
+    params of a Task are normally encoded when it is queued, see WildcardQueue, so
+    building a body is a join of byte strings. Tasks without encoded params get
+    them encoded with the codec here. Commands are numbered 1 to n within a batch,
+    the encoded id suffixes are kept for reuse.
+    """
+    def __init__(self, codec):
+        self.dumps = codec.dumps
+        #Method name to encoded command prefix
+        self.prefixes = dict()
+        #Encoded id suffix fragments by id
+        self.suffixes = [b',"id":0},']
+    def _prefix(self, method):
+        rval = self.prefixes[method] = b'{"jsonrpc":"2.0","method":' + \
+            json.dumps(method).encode("utf8")
+        return rval
+    def encode(self, tasks, omit_empty=False, extra=None):
+        """Body for a batch of tasks with ids 1 to len(tasks), extra is a complete
+           encoded command to add to the batch, omit_empty leaves out empty params"""
+        prefixes = self.prefixes
+        suffixes = self.suffixes
+        while len(suffixes) <= len(tasks):
+            suffixes.append(b',"id":%d},' % len(suffixes))
+        fragments = list()
+        append = fragments.append
+        cmd_id = 0
+        for ttask in tasks:
+            cmd_id += 1
+            prefix = prefixes.get(ttask.method)
+            if prefix is None:
+                prefix = self._prefix(ttask.method)
+            append(prefix)
+            if ttask.params or not omit_empty:
+                encoded = ttask.encoded
+                if encoded is None:
+                    encoded = ttask.encoded = encode_params(self.dumps, ttask.params)
+                append(encoded)
+            append(suffixes[cmd_id])
+        if extra is not None:
+            append(extra)
+        elif fragments:
+            #Drop the comma after the last command.
+            fragments[-1] = fragments[-1][:-1]
+        return b"[" + b"".join(fragments) + b"]"
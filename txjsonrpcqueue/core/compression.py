@@ -0,0 +1,28 @@
+"""HTTP compression policy shared by the asyncio and twisted RpcForwarder"""
+import zlib
+
+class Compression(object):
+    """Negotiated response decompression and optional gzip request body compression.
+
+    Response compression is negotiated with Accept-Encoding and needs nothing from the
+    node. Request bodies are only compressed when threshold is set, as not every node
+    accepts a Content-Encoding on requests.
+    """
+    #pylint: disable=too-few-public-methods
+    def __init__(self, accept=True, threshold=None, level=6):
+        self.accept = accept
+        self.threshold = threshold
+        self.level = level
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+    def encode(self, body):
+        """Compress a request body if it is big enough, returns a (body, content encoding) tuple"""
+        self.raw_bytes += len(body)
+        encoding = None
+        if self.threshold is not None and len(body) >= self.threshold:
+            #wbits 16 + MAX_WBITS gives a gzip header and trailer.
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            encoding = "gzip"
+        self.sent_bytes += len(body)
+        return body, encoding
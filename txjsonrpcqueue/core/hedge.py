@@ -0,0 +1,21 @@
+"""Tail latency hedging policy shared by the asyncio and twisted RpcForwarder"""
+from collections import deque
+
+class HedgePolicy(object):
+    """Learns batch latencies and tells when a slow batch should be re-sent to a second node"""
+    def __init__(self, percentile=0.95, window=200, min_samples=20, min_delay=0.05):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.latencies = deque(maxlen=window)
+        self.hedged = 0
+    def record(self, latency):
+        """Record the latency of a completed batch"""
+        self.latencies.append(latency)
+    def delay(self):
+        """Seconds after which an outstanding batch should be hedged, or None if still learning"""
+        if len(self.latencies) < self.min_samples:
+            return None
+        ordered = sorted(self.latencies)
+        index = min(int(len(ordered) * self.percentile), len(ordered) - 1)
+        return max(ordered[index], self.min_delay)
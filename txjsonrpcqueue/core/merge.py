@@ -0,0 +1,144 @@
+"""Argument level merging of calls to list-taking API methods, shared by the asyncio and
+twisted RpcForwarder"""
+import json
+from txjsonrpcqueue.exception import JsonRpcCommandError, JsonRpcCommandResponseError
+from txjsonrpcqueue.core.wildcardqueue import Task
+
+class MergeRule(object):
+    """How to merge calls to one list-taking method and split the merged result.
+
+    arg is the index of the positional list param or the name of the named one.
+    The result is the list of items, or a dict holding it under result_key. Items
+    are matched with the requested names by their item_key field, so names the node
+    has no item for just don't show up in the result, as for an unmerged call.
+    """
+    #pylint: disable=too-few-public-methods
+    def __init__(self, arg, result_key=None, item_key="name"):
+        self.arg = arg
+        self.result_key = result_key
+        self.item_key = item_key
+
+MERGEABLE = {
+    "condenser_api.get_accounts": MergeRule(0),
+    "database_api.find_accounts": MergeRule("accounts", "accounts"),
+    "rc_api.find_rc_accounts": MergeRule("accounts", "rc_accounts", "account")
+}
+
+class CallMerger(object):
+    """Merges the calls to a list-taking method within a batch into one command.
+
+    The merged command asks for the union of the names, its result is split back over
+    the calls. If the merged command fails with a JSON-RPC error, its calls are
+    requeued to go to the node one by one, so one bad name can't fail the others.
+    """
+    def __init__(self, rules=None, max_items=1000):
+        self.rules = MERGEABLE if rules is None else rules
+        #Maximum number of names in a merged command
+        self.max_items = max_items
+        #Calls that didn't need a command of their own
+        self.merged = 0
+        #Calls requeued after their merged command failed
+        self.unmerged = 0
+    def _group(self, ttask):
+        #Returns (group key, names) for a mergeable task or (None, None)
+        rule = self.rules.get(ttask.method)
+        if rule is None or ttask.merged is not None:
+            return None, None
+        params = ttask.params
+        if isinstance(rule.arg, int):
+            if not isinstance(params, list) or len(params) != rule.arg + 1:
+                return None, None
+            names = params[rule.arg]
+            rest = params[:rule.arg]
+        else:
+            if not isinstance(params, dict) or rule.arg not in params:
+                return None, None
+            names = params[rule.arg]
+            rest = dict(params)
+            del rest[rule.arg]
+        if not isinstance(names, list) or \
+                not all(isinstance(name, str) for name in names):
+            return None, None
+        #Only calls that agree on every other param can be merged.
+        return (ttask.method, json.dumps(rest, sort_keys=True)), names
+    def merge(self, tasks):
+        """The batch to post for a list of tasks, with mergeable calls merged.
+
+        A merged command is a Task with its calls in merged, it takes the place of
+        the first of them.
+        """
+        batch = list()
+        #(index in batch, union of names, calls) for every merged command
+        merges = list()
+        #Group key to the merged command that still takes calls
+        groups = dict()
+        for ttask in tasks:
+            key, names = self._group(ttask)
+            if key is None:
+                batch.append(ttask)
+                continue
+            group = groups.get(key)
+            if group is not None:
+                new = [name for name in names if name not in group[1]]
+                if len(group[1]) + len(new) <= self.max_items:
+                    group[1].update(dict.fromkeys(new))
+                    group[2].append(ttask)
+                    continue
+            #Insertion ordered dict as ordered set of names
+            groups[key] = (len(batch), dict.fromkeys(names), [ttask])
+            merges.append(groups[key])
+            batch.append(ttask)
+        for index, union, calls in merges:
+            if len(calls) > 1:
+                batch[index] = self._merged(calls, list(union))
+                self.merged += len(calls) - 1
+        return batch
+    def _merged(self, calls, names):
+        first = calls[0]
+        rule = self.rules[first.method]
+        if isinstance(rule.arg, int):
+            params = list(first.params)
+        else:
+            params = dict(first.params)
+        params[rule.arg] = names
+        rval = Task(first.method, params, first.lane)
+        rval.merged = calls
+        deadlines = [call.deadline for call in calls if call.deadline is not None]
+        if deadlines:
+            rval.deadline = min(deadlines)
+        return rval
+    def split(self, task, result, resolve, fail):
+        """Resolve the calls of a merged command with their part of its result"""
+        rule = self.rules[task.method]
+        if rule.result_key is None:
+            items = result
+        elif isinstance(result, dict):
+            items = result.get(rule.result_key)
+        else:
+            items = None
+        if not isinstance(items, list):
+            exception = JsonRpcCommandResponseError("Bad merged command result", result)
+            for call in task.merged:
+                fail(call, exception)
+            return
+        by_key = dict()
+        for item in items:
+            if isinstance(item, dict):
+                by_key.setdefault(item.get(rule.item_key), item)
+        for call in task.merged:
+            names = call.params[rule.arg]
+            part = [by_key[name] for name in names if name in by_key]
+            if rule.result_key is not None:
+                part = dict(result, **{rule.result_key: part})
+            resolve(call, part)
+    def failed(self, task, exception, fail, requeue=None):
+        """Fail the calls of a merged command, or requeue them unmerged on a JSON-RPC error"""
+        if requeue is not None and isinstance(exception, JsonRpcCommandError):
+            for call in task.merged:
+                #Don't merge this call again.
+                call.merged = False
+            self.unmerged += len(task.merged)
+            requeue(task.merged)
+            return
+        for call in task.merged:
+            fail(call, exception)
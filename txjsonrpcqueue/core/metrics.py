@@ -0,0 +1,212 @@
+"""Metrics registry shared by the asyncio and twisted implementations.
+
+Hot path events only bump a counter or a histogram bucket. Queue depths, node
+speeds and the state of the other policies are read by collectors when a snapshot
+or a Prometheus scrape is taken.
+"""
+from bisect import bisect_left
+from txjsonrpcqueue.exception import JsonRpcCommandError
+
+BATCH_SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_HELP = {
+    "txjsonrpcqueue_queue_depth": ("gauge", "Commands waiting in the queue"),
+    "txjsonrpcqueue_parked": ("gauge", "Commands waiting for room in a full queue"),
+    "txjsonrpcqueue_enqueued_total": ("counter", "Commands accepted by the queue"),
+    "txjsonrpcqueue_dropped_total": ("counter", "Commands refused by a full queue"),
+    "txjsonrpcqueue_abandoned_total": ("counter",
+                                       "Commands dropped from the queue, cancelled or expired"),
+    "txjsonrpcqueue_cache_hits_total": ("counter", "Commands served from the response cache"),
+    "txjsonrpcqueue_cache_misses_total": ("counter", "Cacheable commands sent to a node"),
+    "txjsonrpcqueue_batch_size": ("histogram", "Commands per posted batch"),
+    "txjsonrpcqueue_batch_size_target": ("gauge", "Adaptive batch size per host"),
+    "txjsonrpcqueue_batch_latency_seconds": ("histogram", "Batch round trip time per host"),
+    "txjsonrpcqueue_http_responses_total": ("counter", "HTTP responses per host and status"),
+    "txjsonrpcqueue_batch_errors_total": ("counter",
+                                          "Batch posts without a response, per host and error"),
+    "txjsonrpcqueue_command_errors_total": ("counter",
+                                            "JSON-RPC error responses per error code"),
+    "txjsonrpcqueue_command_failures_total": ("counter",
+                                              "Commands failed without an error response"),
+    "txjsonrpcqueue_hedged_total": ("counter", "Batches re-sent to a second node"),
+    "txjsonrpcqueue_retried_total": ("counter", "Commands requeued after a transient error"),
+    "txjsonrpcqueue_node_speed_seconds": ("gauge", "Last measured response time per node"),
+}
+
+class Histogram(object):
+    """Fixed bucket histogram"""
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+    def observe(self, value):
+        """Count a value in its bucket"""
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+    def cumulative(self):
+        """List of (upper bound, cumulative count) pairs, ending with +Inf"""
+        total = 0
+        rval = list()
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            rval.append((bound, total))
+        return rval
+
+def _queue_samples(name, core):
+    if hasattr(core, "lanes"):
+        for lane in core.order:
+            for sample in _queue_samples(name, core.lanes[lane]):
+                yield sample[0], sample[1] + (("lane", lane),), sample[2]
+        return
+    labels = (("queue", name),)
+    yield "txjsonrpcqueue_queue_depth", labels, len(core.msg_queue)
+    yield "txjsonrpcqueue_parked", labels, len(core.parked)
+    yield "txjsonrpcqueue_enqueued_total", labels, core.enqueued
+    yield "txjsonrpcqueue_dropped_total", labels, core.dropped
+    yield "txjsonrpcqueue_abandoned_total", labels, core.abandoned_total
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('%s="%s"' % (key, str(value).replace("\\", "\\\\").replace(
+        '"', '\\"').replace("\n", "\\n")) for key, value in labels) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+class MetricsRegistry(object):
+    """Counters, histograms and collectors for queues, forwarders and nodes"""
+    def __init__(self):
+        self.counters = dict()
+        self.histograms = dict()
+        self.collectors = list()
+        self.watched = set()
+        self.queues = 0
+    def inc(self, name, labels=(), amount=1):
+        """Increment a counter, labels is a tuple of (name, value) pairs"""
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + amount
+    def observe(self, name, value, labels=(), buckets=LATENCY_BUCKETS):
+        """Count a value in a histogram"""
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+    def register(self, collector):
+        """Register a callable returning (name, labels, value) samples at collection time"""
+        self.collectors.append(collector)
+    def _watch(self, obj):
+        #Register every object only once, even if more forwarders share it.
+        if id(obj) in self.watched:
+            return False
+        self.watched.add(id(obj))
+        return True
+    def add_queue(self, queue, name=None):
+        """Collect depth and enqueue/drop counts of a WildcardQueue, and its cache hit rate"""
+        if not self._watch(queue):
+            return
+        if name is None:
+            name = "queue%d" % self.queues
+        self.queues += 1
+        def collect():
+            """Queue samples"""
+            for sample in _queue_samples(name, queue.core):
+                yield sample
+            if queue.cache is not None:
+                yield "txjsonrpcqueue_cache_hits_total", (("queue", name),), queue.cache.hits
+                yield "txjsonrpcqueue_cache_misses_total", (("queue", name),), queue.cache.misses
+        self.register(collect)
+    def add_nodes(self, fastest_node):
+        """Collect the node speeds measured by a FastestNode"""
+        if not self._watch(fastest_node):
+            return
+        def collect():
+            """Node speed samples"""
+            for node, speed in list(fastest_node.node_speed.items()):
+                yield "txjsonrpcqueue_node_speed_seconds", (("node", node),), speed
+        self.register(collect)
+    def add_forwarder(self, forwarder):
+        """Collect the adaptive batch sizes and hedge/retry counts of a RpcForwarder"""
+        #Forwarders may share their policies, collect each of them only once.
+        batch_size, hedge, retry = forwarder.batch_size, forwarder.hedge, forwarder.retry
+        if self._watch(batch_size):
+            self.register(lambda: (("txjsonrpcqueue_batch_size_target", (("host", host),), size)
+                                   for host, size in batch_size.snapshot().items()))
+        if hedge is not None and self._watch(hedge):
+            self.register(lambda: [("txjsonrpcqueue_hedged_total", (), hedge.hedged)])
+        if retry is not None and self._watch(retry):
+            self.register(lambda: [("txjsonrpcqueue_retried_total", (), retry.retried)])
+    def batch(self, size):
+        """A forwarder posts a batch"""
+        self.observe("txjsonrpcqueue_batch_size", size, buckets=BATCH_SIZE_BUCKETS)
+    def status(self, host, code):
+        """A node answered a batch with an HTTP status code"""
+        self.inc("txjsonrpcqueue_http_responses_total", (("host", host), ("code", code)))
+    def latency(self, host, latency):
+        """A batch response from a node was complete"""
+        self.observe("txjsonrpcqueue_batch_latency_seconds", latency, (("host", host),))
+    def batch_error(self, host, exception):
+        """A batch post to a node failed as a whole"""
+        self.inc("txjsonrpcqueue_batch_errors_total",
+                 (("host", host), ("error", type(exception).__name__)))
+    def counting_fail(self, fail):
+        """Wrap the command fail function of a forwarder, counting failures"""
+        def counted_fail(task, exception):
+            """Count the command failure, then fail the command"""
+            if isinstance(exception, JsonRpcCommandError):
+                self.inc("txjsonrpcqueue_command_errors_total", (("code", exception.code),))
+            else:
+                self.inc("txjsonrpcqueue_command_failures_total",
+                         (("error", type(exception).__name__),))
+            fail(task, exception)
+        return counted_fail
+    def _samples(self):
+        samples = dict()
+        for (name, labels), value in self.counters.items():
+            samples.setdefault(name, list()).append((labels, value))
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                samples.setdefault(name, list()).append((labels, value))
+        for (name, labels), histogram in self.histograms.items():
+            samples.setdefault(name, list()).append((labels, histogram))
+        return samples
+    def snapshot(self):
+        """Map from metric name to a list of (labels dict, value) pairs.
+
+        Histogram values are dicts with count, sum and cumulative buckets.
+        """
+        rval = dict()
+        for name, samples in self._samples().items():
+            rval[name] = list()
+            for labels, value in samples:
+                if isinstance(value, Histogram):
+                    value = {"count": value.count, "sum": value.sum,
+                             "buckets": value.cumulative()}
+                rval[name].append((dict(labels), value))
+        return rval
+    def prometheus(self):
+        """The metrics in the Prometheus text exposition format"""
+        lines = list()
+        for name, samples in sorted(self._samples().items()):
+            kind, text = _HELP.get(name, ("untyped", name))
+            lines.append("# HELP %s %s" % (name, text))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value in samples:
+                if isinstance(value, Histogram):
+                    for bound, count in value.cumulative():
+                        lines.append("%s_bucket%s %d" % (
+                            name, _format_labels(labels + (("le", _format_value(bound)),)),
+                            count))
+                    lines.append("%s_sum%s %s" % (name, _format_labels(labels),
+                                                  _format_value(value.sum)))
+                    lines.append("%s_count%s %d" % (name, _format_labels(labels), value.count))
+                else:
+                    lines.append("%s%s %s" % (name, _format_labels(labels),
+                                              _format_value(value)))
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,288 @@
+"""Framework independent core of the local mock Steem JSON-RPC node.
+
+The node answers JSON-RPC batches from synthetic, deterministic fixtures and can
+inject latency, jitter, 413 and 5xx responses, jussi style "id": null errors,
+truncated bodies and a batch size limit. The twisted and asyncio variants only
+add the HTTP server around MockNode.handle.
+"""
+import json
+import random
+import time
+import zlib
+
+def _operation(rnd, index):
+    kind = index % 4
+    if kind == 0:
+        return ["vote", {"voter": "voter%d" % rnd.randint(0, 9999),
+                         "author": "author%d" % rnd.randint(0, 999),
+                         "permlink": "some-post-permlink-%d" % rnd.randint(0, 99999),
+                         "weight": rnd.randint(-10000, 10000)}]
+    if kind == 1:
+        return ["transfer", {"from": "sender%d" % rnd.randint(0, 9999),
+                             "to": "receiver%d" % rnd.randint(0, 9999),
+                             "amount": "%d.%03d STEEM" % (rnd.randint(0, 9999),
+                                                          rnd.randint(0, 999)),
+                             "memo": "memo text %d" % rnd.randint(0, 99999)}]
+    if kind == 2:
+        return ["custom_json", {"required_auths": [],
+                                "required_posting_auths": ["poster%d" % rnd.randint(0, 999)],
+                                "id": "follow",
+                                "json": "[\"follow\",{\"follower\":\"a%d\",\"following\":"
+                                        "\"b%d\",\"what\":[\"blog\"]}]" % (
+                                            rnd.randint(0, 999), rnd.randint(0, 999))}]
+    return ["comment", {"parent_author": "", "parent_permlink": "steem",
+                        "author": "author%d" % rnd.randint(0, 999),
+                        "permlink": "post-%d" % rnd.randint(0, 99999),
+                        "title": "A title for a post",
+                        "body": "Lorem ipsum dolor sit amet. " * rnd.randint(1, 40),
+                        "json_metadata": "{\"tags\":[\"steem\",\"life\"],\"app\":\"x/0.1\"}"}]
+
+def _timestamp(block_num):
+    #Three second blocks
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(1451606400 + 3 * block_num))
+
+def synthetic_block(block_num, transactions=40):
+    """A deterministic synthetic condenser_api get_block result"""
+    rnd = random.Random(block_num)
+    txs = list()
+    for index in range(transactions):
+        txs.append({"ref_block_num": block_num & 0xffff,
+                    "ref_block_prefix": rnd.randint(0, 2**32),
+                    "expiration": _timestamp(block_num + 20),
+                    "operations": [_operation(rnd, index + opnum)
+                                   for opnum in range(rnd.randint(1, 3))],
+                    "extensions": [],
+                    "signatures": ["%0130x" % rnd.getrandbits(520)]})
+    return {"previous": "%08x" % (block_num - 1) + "%032x" % rnd.getrandbits(128),
+            "timestamp": _timestamp(block_num),
+            "witness": "witness%d" % rnd.randint(0, 20),
+            "transaction_merkle_root": "%040x" % rnd.getrandbits(160),
+            "extensions": [],
+            "witness_signature": "%0130x" % rnd.getrandbits(520),
+            "transactions": txs,
+            "block_id": "%08x" % block_num + "%032x" % rnd.getrandbits(128),
+            "signing_key": "STM" + "%050x" % rnd.getrandbits(200),
+            "transaction_ids": ["%040x" % rnd.getrandbits(160) for _ in txs]}
+
+def _header(block):
+    return dict((key, block[key]) for key in ("previous", "timestamp", "witness",
+                                              "transaction_merkle_root", "extensions"))
+
+def _account(name):
+    rnd = random.Random(name)
+    return {"name": name, "balance": "%d.%03d STEEM" % (rnd.randint(0, 99999),
+                                                        rnd.randint(0, 999)),
+            "vesting_shares": "%d.%06d VESTS" % (rnd.randint(0, 9999999),
+                                                 rnd.randint(0, 999999)),
+            "post_count": rnd.randint(0, 5000), "json_metadata": "{}"}
+
+class _CallError(Exception):
+    def __init__(self, code, message):
+        super(_CallError, self).__init__(message)
+        self.code = code
+        self.message = message
+
+def _param(params, index, name, default=None):
+    #Appbase APIs take named params, condenser_api takes positional ones.
+    if isinstance(params, dict):
+        return params.get(name, default)
+    if isinstance(params, list) and len(params) > index:
+        return params[index]
+    return default
+
+def decode_body(body, encoding=None):
+    """Decode a request body with its Content-Encoding, None for an unsupported encoding"""
+    if encoding in (None, "", "identity"):
+        return body
+    if encoding == "gzip":
+        try:
+            return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        except zlib.error:
+            #Let the node answer a broken body as invalid JSON.
+            return body
+    return None
+
+class MockNode(object):
+    """Fixture backed JSON-RPC batch handler with fault injection.
+
+    fixtures maps a full method name to a static result or to a callable taking the
+    params, and overrides or extends the built in Steem API methods. Rates are
+    per batch, except for truncate_rate which is per response body.
+    """
+    #pylint: disable=too-many-instance-attributes,too-many-arguments
+    def __init__(self, fixtures=None, latency=0.0, jitter=0.0, error_rate=0.0, error_status=503,
+                 max_batch=None, null_id_rate=0.0, truncate_rate=0.0, block_transactions=40,
+                 head_block=20000000, nodes=None, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.max_batch = max_batch
+        self.null_id_rate = null_id_rate
+        self.truncate_rate = truncate_rate
+        self.block_transactions = block_transactions
+        self.random = random.Random(seed)
+        #The head block moves on every three seconds from head_block.
+        self.start_block = head_block
+        self.start_time = time.time()
+        #API node list published in the fullnodeupdate account, for the injectors.
+        self.nodes = nodes or list()
+        self.stats = {"posts": 0, "commands": 0, "status": dict(), "faults": dict()}
+        #Full length of the last response body if it was truncated
+        self.untruncated = None
+        #Serialized results of immutable calls
+        self.results = dict()
+        self.methods = {
+            "get_block": self._get_block,
+            "get_block_header": self._get_block_header,
+            "get_ops_in_block": self._get_ops_in_block,
+            "get_dynamic_global_properties": self._get_dynamic_global_properties,
+            "get_accounts": self._get_accounts,
+            "find_accounts": self._find_accounts,
+            "find_rc_accounts": self._find_rc_accounts,
+            "get_config": lambda api, params: {"STEEM_BLOCK_INTERVAL": 3,
+                                               "STEEM_CHAIN_ID": "0" * 64},
+            "get_version": lambda api, params: {"blockchain_version": "0.20.2",
+                                                "steem_revision": "mock", "fc_revision": "mock"},
+        }
+        self.fixtures = fixtures or dict()
+    def head_block(self):
+        """Current head block number"""
+        return self.start_block + int((time.time() - self.start_time) / 3)
+    def delay(self):
+        """Seconds to wait before answering a batch"""
+        return self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0.0)
+    def content_length(self, body):
+        """Content-Length for the body from the last handle call.
+
+        A truncated body announces its full length, the server then closes the
+        connection after the partial body, like a node dying mid-response.
+        """
+        return self.untruncated or len(body)
+    def _block(self, block_num):
+        if not isinstance(block_num, int) or block_num < 1 or block_num > self.head_block():
+            return None
+        return synthetic_block(block_num, self.block_transactions)
+    def _get_block(self, api, params):
+        block = self._block(_param(params, 0, "block_num"))
+        if api == "block_api":
+            return {"block": block} if block is not None else {}
+        return block
+    def _get_block_header(self, api, params):
+        block = self._block(_param(params, 0, "block_num"))
+        header = _header(block) if block is not None else None
+        if api == "block_api":
+            return {"header": header} if header is not None else {}
+        return header
+    def _get_ops_in_block(self, api, params):
+        block_num = _param(params, 0, "block_num")
+        block = self._block(block_num)
+        ops = list()
+        if block is not None:
+            for index, trx in enumerate(block["transactions"]):
+                for opnum, operation in enumerate(trx["operations"]):
+                    ops.append({"trx_id": block["transaction_ids"][index], "block": block_num,
+                                "trx_in_block": index, "op_in_trx": opnum, "virtual_op": 0,
+                                "timestamp": block["timestamp"], "op": operation})
+        if api == "account_history_api":
+            return {"ops": ops}
+        return ops
+    def _get_dynamic_global_properties(self, api, params):
+        #pylint: disable=unused-argument
+        head = self.head_block()
+        return {"head_block_number": head, "head_block_id": "%08x" % head + "0" * 32,
+                "time": _timestamp(head), "current_witness": "witness%d" % (head % 21),
+                "last_irreversible_block_num": head - 20}
+    def _get_accounts(self, api, params):
+        #pylint: disable=unused-argument
+        names = _param(params, 0, "names", list())
+        accounts = list()
+        for name in names:
+            account = _account(name)
+            if name == "fullnodeupdate":
+                account["json_metadata"] = json.dumps({"nodes": self.nodes, "failing_nodes": {},
+                                                       "report": list()})
+            accounts.append(account)
+        return accounts
+    def _find_accounts(self, api, params):
+        return {"accounts": self._get_accounts(api, [_param(params, 0, "accounts", list())])}
+    def _find_rc_accounts(self, api, params):
+        #pylint: disable=unused-argument
+        names = _param(params, 0, "accounts", list())
+        return {"rc_accounts": [{"account": name, "rc_manabar": {"current_mana": 10**9,
+                                                                  "last_update_time": 0},
+                                 "max_rc": 10**9} for name in names]}
+    def _result_json(self, method, params):
+        if method in self.fixtures:
+            fixture = self.fixtures[method]
+            return json.dumps(fixture(params) if callable(fixture) else fixture)
+        api, _, name = method.rpartition(".")
+        if name not in self.methods or api not in ("condenser_api", "block_api", "database_api",
+                                                   "account_history_api", "rc_api", ""):
+            raise _CallError(-32601, "Could not find method " + method)
+        #Blocks up to the head block never change, keep their serialized results.
+        block_num = _param(params, 0, "block_num")
+        key = None
+        if name in ("get_block", "get_block_header", "get_ops_in_block") and \
+                isinstance(block_num, int) and 0 < block_num <= self.head_block():
+            key = (method, json.dumps(params, sort_keys=True))
+            if key in self.results:
+                return self.results[key]
+        rval = json.dumps(self.methods[name](api, params))
+        if key is not None and len(self.results) < 10000:
+            self.results[key] = rval
+        return rval
+    def _command(self, cmd):
+        cmd_id = json.dumps(cmd.get("id")) if isinstance(cmd, dict) else "null"
+        try:
+            if not isinstance(cmd, dict) or not isinstance(cmd.get("method"), str):
+                raise _CallError(-32600, "Invalid Request")
+            method, params = cmd["method"], cmd.get("params", list())
+            if method == "call" and isinstance(params, list) and len(params) == 3:
+                #Old style: call(api, method, params)
+                method, params = str(params[0]) + "." + str(params[1]), params[2]
+            result = self._result_json(method, params)
+            return '{"jsonrpc":"2.0","id":%s,"result":%s}' % (cmd_id, result)
+        except _CallError as exception:
+            return '{"jsonrpc":"2.0","id":%s,"error":%s}' % (cmd_id, json.dumps(
+                {"code": exception.code, "message": exception.message}))
+    def _fault(self, name):
+        self.stats["faults"][name] = self.stats["faults"].get(name, 0) + 1
+    def _status(self, status, body):
+        self.stats["status"][status] = self.stats["status"].get(status, 0) + 1
+        return status, body
+    def handle(self, body):
+        """Handle a posted request body, returns a (HTTP status, response body) tuple"""
+        self.stats["posts"] += 1
+        self.untruncated = None
+        try:
+            batch = json.loads(body)
+        except ValueError:
+            return self._status(400, b"Invalid JSON in request")
+        single = not isinstance(batch, list)
+        if single:
+            batch = [batch]
+        self.stats["commands"] += len(batch)
+        if self.max_batch is not None and len(batch) > self.max_batch:
+            self._fault("max_batch")
+            return self._status(413, b"Request Entity Too Large")
+        if self.error_rate and self.random.random() < self.error_rate:
+            self._fault("error")
+            return self._status(self.error_status, b"Service Unavailable")
+        if self.null_id_rate and self.random.random() < self.null_id_rate:
+            #jussi answers a whole batch with a single error without an id.
+            self._fault("null_id")
+            return self._status(200, json.dumps({
+                "jsonrpc": "2.0", "id": None, "error": {
+                    "code": -32603, "message": "Internal Error",
+                    "data": {"error_id": "%032x" % self.random.getrandbits(128)}}}).encode())
+        responses = [self._command(cmd) for cmd in batch]
+        if single:
+            rval = responses[0].encode()
+        else:
+            rval = ("[" + ",".join(responses) + "]").encode()
+        if self.truncate_rate and self.random.random() < self.truncate_rate:
+            self._fault("truncate")
+            self.untruncated = len(rval)
+            rval = rval[:self.random.randint(0, len(rval) - 1)]
+        return self._status(200, rval)
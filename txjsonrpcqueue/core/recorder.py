@@ -0,0 +1,171 @@
+"""Recording of batch traffic to JSONL capture files, and replay of the recordings.
+
+Every line of a capture file is one posted batch: the wall clock time it was posted,
+the host, the round trip time, the HTTP status and the raw request and response
+bodies. Posts that got no response have a null status and the exception name.
+"""
+import collections
+import json
+import zlib
+
+def _text(body):
+    #Keeps undecodable bytes round trippable through JSON
+    return body.decode("utf8", "surrogateescape")
+
+def _bytes(text):
+    return text.encode("utf8", "surrogateescape")
+
+class Recorder(object):
+    """Appends the batches of one or more RpcForwarder objects to a JSONL capture file"""
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "a")
+        self.records = 0
+    def record(self, host, start, latency, request, status=None, response=None, encoding=None,
+               error=None):
+        """Append one posted batch, request and response are the raw bodies"""
+        #pylint: disable=too-many-arguments
+        if self.file is None:
+            return
+        if encoding == "gzip":
+            #Record what the node got after decoding, not the compressed bytes.
+            request = zlib.decompress(request, 16 + zlib.MAX_WBITS)
+        record = {"t": round(start, 6), "host": host, "latency": round(latency, 6),
+                  "status": status, "request": _text(request)}
+        if response is not None:
+            record["response"] = _text(response)
+        if error is not None:
+            record["error"] = type(error).__name__
+        self.file.write(json.dumps(record, separators=(",", ":")) + "\n")
+        #A capture should survive a crash of the process that records it.
+        self.file.flush()
+        self.records += 1
+    def close(self):
+        """Close the capture file"""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+def read_recording(path):
+    """Iterate over the records in a capture file"""
+    with open(path) as capture:
+        for line in capture:
+            if line.strip():
+                yield json.loads(line)
+
+def _command_key(cmd):
+    return (cmd.get("method"), json.dumps(cmd.get("params"), sort_keys=True,
+                                          separators=(",", ":")))
+
+def _batch_key(batch):
+    if isinstance(batch, list):
+        return tuple(_command_key(cmd) for cmd in batch if isinstance(cmd, dict))
+    if isinstance(batch, dict):
+        return (_command_key(batch),)
+    return None
+
+def _loads(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return None
+
+def _ids(batch):
+    if isinstance(batch, list):
+        return [cmd.get("id") if isinstance(cmd, dict) else None for cmd in batch]
+    return [batch.get("id")]
+
+class ReplayNode(object):
+    """Serves the responses from a capture file, with the recorded latency divided by speed.
+
+    Has the handle, delay and content_length methods of MockNode, so it can be served
+    with listen_mock_node. A batch identical to a recorded one, ids aside, gets the recorded
+    response, errors and HTTP status included. Identical batches get their recordings
+    in turn. Other batches are assembled from the recorded responses of their commands.
+    """
+    def __init__(self, path, speed=1.0):
+        self.speed = speed
+        #Batch key to recorded (status, response text, latency, request ids) answers
+        self.batches = dict()
+        #Command key to (recorded response without id, latency)
+        self.commands = dict()
+        self.stats = {"posts": 0, "commands": 0, "exact": 0, "assembled": 0, "missing": 0}
+        self.last_delay = 0.0
+        for record in read_recording(path):
+            if record.get("status") is None:
+                continue
+            request = _loads(record["request"])
+            key = _batch_key(request)
+            if key is None:
+                continue
+            answer = (record["status"], record.get("response", ""), record["latency"],
+                      _ids(request))
+            self.batches.setdefault(key, collections.deque()).append(answer)
+            response = _loads(answer[1])
+            if 199 < record["status"] < 300 and isinstance(request, list) and \
+                    isinstance(response, list):
+                by_id = dict((resp.get("id"), resp) for resp in response
+                             if isinstance(resp, dict))
+                for cmd in request:
+                    if isinstance(cmd, dict) and cmd.get("id") in by_id:
+                        resp = dict(by_id[cmd["id"]])
+                        resp.pop("id")
+                        self.commands.setdefault(_command_key(cmd), (resp, record["latency"]))
+    def delay(self):
+        """Seconds to wait before answering the batch handled last"""
+        return self.last_delay
+    def content_length(self, body):
+        """Content-Length for the body from the last handle call, recordings are complete"""
+        #pylint: disable=no-self-use
+        return len(body)
+    def _exact(self, batch, answers):
+        status, text, latency, recorded_ids = answers[0]
+        #Identical batches get their recordings in turn.
+        answers.rotate(-1)
+        self.stats["exact"] += 1
+        self.last_delay = latency / self.speed
+        response = _loads(text)
+        if isinstance(response, (list, dict)):
+            #Give the responses the ids of the commands in this batch, by position.
+            new_ids = dict(zip(recorded_ids, _ids(batch)))
+            for resp in response if isinstance(response, list) else [response]:
+                if isinstance(resp, dict) and resp.get("id") in new_ids:
+                    resp["id"] = new_ids[resp["id"]]
+            return status, json.dumps(response, separators=(",", ":")).encode()
+        return status, _bytes(text)
+    def _assemble(self, batch):
+        #Returns the command responses, setting the delay from the slowest one.
+        responses = list()
+        latency = 0.0
+        for cmd in batch:
+            if not isinstance(cmd, dict):
+                continue
+            recorded = self.commands.get(_command_key(cmd))
+            if recorded is None:
+                self.stats["missing"] += 1
+                resp = {"jsonrpc": "2.0", "error": {"code": -32601,
+                                                    "message": "Not in recording"}}
+            else:
+                resp, cmd_latency = dict(recorded[0]), recorded[1]
+                latency = max(latency, cmd_latency)
+            resp["id"] = cmd.get("id")
+            responses.append(resp)
+        self.stats["assembled"] += 1
+        self.last_delay = latency / self.speed
+        return responses
+    def handle(self, body):
+        """Handle a posted request body, returns a (HTTP status, response body) tuple"""
+        self.stats["posts"] += 1
+        batch = _loads(body)
+        key = _batch_key(batch)
+        if key is None:
+            self.last_delay = 0.0
+            return 400, b"Invalid JSON in request"
+        self.stats["commands"] += len(key)
+        if key in self.batches:
+            return self._exact(batch, self.batches[key])
+        if isinstance(batch, list):
+            response = self._assemble(batch)
+        else:
+            response = self._assemble([batch])[0]
+        return 200, json.dumps(response, separators=(",", ":")).encode()
@@ -0,0 +1,37 @@
+"""Retry policy for transient batch failures shared by the asyncio and twisted RpcForwarder"""
+import random
+from txjsonrpcqueue.exception import HttpServerError, SSLError, SSLNameMismatch
+
+class RetryPolicy(object):
+    """Per command retry budget with full-jitter exponential backoff.
+
+    Failed hosts are avoided for penalty seconds, so retries fail over to an other
+    healthy node when the injector knows one.
+    """
+    #pylint: disable=too-many-arguments
+    def __init__(self, retries=3, base_delay=0.1, max_delay=5.0, penalty=10.0):
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.penalty = penalty
+        self.retried = 0
+    def transient(self, exception, transient_types=()):
+        """Check if a batch level exception is worth retrying"""
+        if isinstance(exception, SSLNameMismatch):
+            return False
+        return isinstance(exception, (HttpServerError, SSLError, ConnectionError) +
+                          tuple(transient_types))
+    def retryable(self, task):
+        """Check if a task has retry budget left"""
+        return task.retries < self.retries
+    def take(self, batch):
+        """Take the tasks with retry budget left out of a failed CoreBatch"""
+        tasks = batch.take_unprocessed(self.retryable)
+        for task in tasks:
+            task.retries += 1
+        self.retried += len(tasks)
+        return tasks
+    def delay(self, tasks):
+        """Backoff before requeueing tasks, based on their highest retry count"""
+        attempt = max(task.retries for task in tasks)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
@@ -0,0 +1,277 @@
+"""Shared code between RpcForwarder implementations for asyncio and twisted"""
+import json
+import re
+import time
+from txjsonrpcqueue.exception import HttpServerError, HttpClientError, JsonRpcBatchError
+from txjsonrpcqueue.exception import JsonRpcCommandError, JsonRpcCommandResponseError
+
+def parse_batch_response(code, text, loads=json.loads):
+    """Parse a JSON-RPC batch response body, returns a (response list, exception) tuple.
+
+    loads is the decode function of the JSON codec in use, see core.codec.
+    """
+    try:
+        #Parse the JSON content of the JSON-RPC batch response.
+        resp_obj = loads(text)
+    except ValueError:
+        #Convert a json parse error and HTTP error code into appropriate exception type
+        if isinstance(text, bytes):
+            text = text.decode("utf8", "replace")
+        if code > 499: #5xx server side error codes
+            return None, HttpServerError(code, text)
+        if code > 399: #4xx client side errors.
+            return None, HttpClientError(code, text)
+        # Non-error code in the 2xx and 3xx range.
+        return None, JsonRpcBatchError(code, text, "Invalid JSON returned by server")
+    #Assert the parsed JSON is a list.
+    if not isinstance(resp_obj, list):
+        if isinstance(text, bytes):
+            text = text.decode("utf8", "replace")
+        return None, JsonRpcBatchError(code, text, "Non-batch JSON response from server.")
+    return resp_obj, None
+
+#The end of a command response, followed by the start of the next one. A match inside a
+# response is possible, the codec then refuses the slice ending there.
+_ELEMENT_END = re.compile(rb'}[ \t\n\r]*,[ \t\n\r]*{[ \t\n\r]*"(?:jsonrpc|id|result|error)"')
+#Longest match we expect, for searching new data only
+_ELEMENT_END_MAX = 64
+
+class StreamingBatchParser(object):
+    """Incremental parser for a JSON-RPC batch response body.
+
+    Walks the top level JSON array as chunks arrive and calls on_response with the
+    command responses as soon as their elements are complete, keeping only the
+    incomplete element in memory. Likely element ends are found with a regular
+    expression, the complete elements up to the last one are decoded with the codec
+    in one go. Bodies that are no 2xx JSON array are buffered and left to
+    parse_batch_response and the codec, so errors are classified exactly as for a
+    buffered body. With record set, the raw body is kept for a Recorder.
+    """
+    #pylint: disable=too-many-instance-attributes,too-many-arguments
+    def __init__(self, code, on_response, loads=json.loads, stream=True, record=False):
+        self.code = code
+        self.on_response = on_response
+        self.loads = loads
+        self.size = 0
+        #Parsed command responses
+        self.responses = list()
+        #None until the first non whitespace byte tells us if this is an array we can stream.
+        self.streaming = None if stream and 199 < code < 300 else False
+        self.chunks = list()
+        #Undecoded body, starting at the next element
+        self.buffer = bytearray()
+        #Offset in buffer to search for element ends from, and the ends found so far
+        self.searched = 0
+        self.ends = list()
+        #Don't retry decoding before the buffer doubled, keeps parsing linear on bad input.
+        self.retry_at = 0
+        self.separator = False
+        self.exception = None
+        self.recorded = list() if record else None
+    def feed(self, data):
+        """Feed the next chunk of the response body"""
+        self.size += len(data)
+        if self.recorded is not None:
+            self.recorded.append(data)
+        if self.streaming is None:
+            self.chunks.append(data)
+            head = b"".join(self.chunks).lstrip()
+            if not head:
+                return
+            self.streaming = head[:1] == b"["
+            if not self.streaming:
+                return
+            self.chunks = list()
+            data = head[1:]
+        if not self.streaming:
+            self.chunks.append(data)
+        elif self.exception is None:
+            self.buffer += data
+            if len(self.buffer) >= self.retry_at:
+                self._scan()
+    def _invalid(self):
+        self.exception = JsonRpcBatchError(self.code, self.buffer.decode("utf8", "replace"),
+                                           "Invalid JSON returned by server")
+    def _dispatch(self, responses):
+        self.responses.extend(responses)
+        for response in responses:
+            self.on_response(response)
+    def _scan(self):
+        buffer = self.buffer
+        last = self.ends[-1] if self.ends else 0
+        for match in _ELEMENT_END.finditer(buffer, self.searched):
+            if match.start() + 1 > last:
+                self.ends.append(match.start() + 1)
+        self.searched = max(self.searched, len(buffer) - _ELEMENT_END_MAX)
+        #Decode up to the last end the codec takes, later ones are inside an element.
+        while self.ends:
+            end = self.ends.pop()
+            try:
+                responses = self.loads(b"[" + bytes(buffer[:end]) + b"]")
+            except ValueError:
+                continue
+            #Drop the decoded elements and the separator after them.
+            del buffer[:buffer.index(b",", end) + 1]
+            self.separator = True
+            self.ends = list()
+            self.searched = max(len(buffer) - _ELEMENT_END_MAX, 0)
+            self.retry_at = 0
+            self._dispatch(responses)
+            return
+        self.retry_at = 2 * len(buffer)
+    def raw_body(self):
+        """The raw response body, if recorded"""
+        return b"".join(self.recorded or ())
+    def finish(self):
+        """The body is complete, returns a (response list, exception) tuple"""
+        if not self.streaming:
+            return parse_batch_response(self.code, b"".join(self.chunks), self.loads)
+        if self.exception is None:
+            rest = bytes(self.buffer).lstrip()
+            try:
+                if self.separator and rest[:1] == b"]":
+                    #Trailing comma
+                    raise ValueError(rest)
+                responses = self.loads(b"[" + rest)
+            except ValueError:
+                #Truncated or invalid body, pass on the complete elements before the damage.
+                self.searched = 0
+                self.ends = list()
+                self._scan()
+                self._invalid()
+            else:
+                self._dispatch(responses)
+        return self.responses, self.exception
+
+def batch_timeout(batch_in, timeout=None):
+    """HTTP timeout for a batch: the forwarder timeout or the tightest command deadline,
+       and whether a command deadline set it"""
+    deadlines = [cmd.deadline for cmd in batch_in if cmd.deadline is not None]
+    if deadlines:
+        remaining = max(min(deadlines) - time.time(), 0.001)
+        if timeout is None or remaining < timeout:
+            return remaining, True
+    return timeout, False
+
+def unexpired(task, by_deadline=False):
+    """Check if a task has time left after its batch timed out.
+
+    If a command deadline set the batch timeout, commands without a deadline have time
+    left too, else they ran into the forwarder timeout themselves.
+    """
+    if task.deadline is None:
+        return by_deadline
+    return task.deadline > time.time()
+
+class CoreBatch(object):
+    """Bookkeeping for one JSON-RPC batch that may be posted to more than one node.
+
+    The first response for a command wins. Batch level errors and missing command
+    responses only count once no posted copy of the batch is pending anymore.
+    """
+    def __init__(self, tasks, resolve, fail, on_complete, merger=None, requeue=None,
+                 filler=False):
+        #pylint: disable=too-many-arguments
+        #Map from JSON-RPC id to task
+        self.tasks = tasks
+        #Number of commands in a posted copy, a filler command included
+        self.size = len(tasks) + (1 if filler else 0)
+        #Set of unprocessed ids
+        self.unprocessed = set(tasks)
+        self.resolve = resolve
+        self.fail = fail
+        #Optional CallMerger that merged some of the tasks, and requeue for their calls.
+        self.merger = merger
+        self.requeue = requeue
+        self.on_complete = on_complete
+        self.pending = 0
+        self.completed = False
+        #Functions cancelling the posted copies, for when an other copy completes the batch
+        self.cancellers = list()
+        #Functions cancelling delayed actions for the batch, like hedging, once it completed
+        self.timers = list()
+    def posted(self, cancel=None):
+        """A copy of the batch was posted to a node, cancel stops it"""
+        self.pending += 1
+        if cancel is not None:
+            self.cancellers.append(cancel)
+    def later(self, cancel):
+        """A delayed action for the batch was scheduled, cancel stops it"""
+        if self.completed:
+            cancel()
+        else:
+            self.timers.append(cancel)
+    def take_unprocessed(self, select=None):
+        """Take the (selected) tasks without a response yet out of the batch, for requeueing"""
+        rval = list()
+        for query_id in sorted(self.unprocessed):
+            task = self.tasks[query_id]
+            if task.merged:
+                #Requeue the selected calls of a merged command, the others stay in it.
+                calls = [call for call in task.merged if select is None or select(call)]
+                task.merged = [call for call in task.merged if call not in calls]
+                rval.extend(calls)
+                if not task.merged:
+                    self.unprocessed.remove(query_id)
+            elif select is None or select(task):
+                self.unprocessed.remove(query_id)
+                rval.append(task)
+        return rval
+    def copy_done(self, resp_obj=None, exception=None):
+        """A posted copy of the batch completed with a response list or a batch level error"""
+        self.pending -= 1
+        if resp_obj:
+            self._process_response_list(resp_obj)
+        if self.unprocessed and self.pending == 0:
+            if exception is None:
+                exception = JsonRpcCommandResponseError(
+                    "Request command id not found in response.", resp_obj)
+            #Work through any request item id without a valid response.
+            for query_id in self.unprocessed:
+                self._fail(self.tasks[query_id], exception)
+            self.unprocessed.clear()
+        if not self.completed and (self.pending == 0 or not self.unprocessed):
+            self.completed = True
+            self.on_complete()
+            if self.pending:
+                #A hedged copy still running lost the race, free its connection and node.
+                for cancel in self.cancellers:
+                    cancel()
+            self.cancellers = None
+            for cancel in self.timers:
+                cancel()
+            self.timers = list()
+    def _process_response_list(self, resp_obj):
+        #Process the individual command responses
+        for response in resp_obj:
+            self.process_response(response)
+    def process_response(self, response):
+        """Process a single command response, possibly before the full batch response is in"""
+        #Get the id from the response to match with the apropriate reuest
+        if isinstance(response, dict) and response.get("id") in self.unprocessed:
+            query_id = response["id"]
+            #Maintain list of unprocessed id's
+            self.unprocessed.remove(query_id)
+            #Look up the proper command task to map this response to.
+            task = self.tasks[query_id]
+            #Distinguish between responses and errors.
+            if "result" in response:
+                self._resolve(task, response["result"])
+            elif isinstance(response.get("error"), dict) and \
+                    "message" in response["error"] and "code" in response["error"]:
+                self._fail(task, JsonRpcCommandError(response["error"]["code"],
+                                                     response["error"]["message"],
+                                                     response["error"].get("data")))
+            else:
+                self._fail(task, JsonRpcCommandResponseError(
+                    "Bad command response from server", response))
+    def _resolve(self, task, result):
+        if task.merged:
+            self.merger.split(task, result, self.resolve, self.fail)
+        else:
+            self.resolve(task, result)
+    def _fail(self, task, exception):
+        if task.merged:
+            self.merger.failed(task, exception, self.fail, self.requeue)
+        else:
+            self.fail(task, exception)
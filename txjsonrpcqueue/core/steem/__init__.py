@@ -1,2 +1,3 @@
 """Core implementation of STEEM specific classes"""
 from txjsonrpcqueue.core.steem.injector import MonitorSet, FastestNode
+from txjsonrpcqueue.core.steem.streamer import CoreBlockStreamer
@@ -8,17 +8,27 @@ from txjsonrpcqueue.exception import HttpClientError
 class FastestNode(object):
     #pylint: disable=too-few-public-methods
     """Helper class for keeping track of the fastest node."""
-    def __init__(self, defaultnode, inject):
+    def __init__(self, defaultnode, inject, inject_set=None):
         self.node_speed = dict()
         self.node_settime = dict()
         self.best_node = defaultnode
         self.inject = inject
+        self.inject_set = inject_set
         self.best_speed = 1000000.0
         self.best_settime = 0.0
+    def healthy_nodes(self):
+        """Map from node URL to speed for all nodes that reported a speed recently"""
+        now = time.time()
+        return dict((node, speed) for node, speed in self.node_speed.items()
+                    if now - self.node_settime[node] <= 60 + speed)
     def set_node_speed(self, node, speed):
         """Set the node speed for a specific node URL"""
         self.node_speed[node] = speed
         self.node_settime[node] = time.time()
+        if self.inject_set:
+            #Every speed update re-injects the full set of healthy nodes, whatever the mode.
+            # Hedging and failover use the set too, only balancing depends on the mode.
+            self.inject_set(self.healthy_nodes())
         if speed <= self.best_speed:
             #There is no dispute, this is the fastest node
             if self.best_node != node:
@@ -0,0 +1,116 @@
+"""Core implementation of the prefetching block streamer"""
+import time
+
+class CoreBlockStreamer(object):
+    """Fetches block_api.get_block over a range with a sliding prefetch window and delivers
+    the blocks strictly in order. Once the chain head is reached, the head is polled with
+    get_dynamic_global_properties and new blocks are fetched as they appear.
+
+    on_block is called with the block number and the block. The window bounds the blocks
+    fetched but not yet released, wrappers call release() once a block was consumed.
+    """
+    #pylint: disable=too-many-instance-attributes,too-many-arguments
+    def __init__(self, portable, queue, on_block, start, end=None, window=100, poll_interval=3.0,
+                 irreversible=False, on_error=None, on_done=None):
+        if window < 1:
+            raise ValueError("Block streamer window should be at least one")
+        self.portable = portable
+        self.queue = queue
+        self.on_block = on_block
+        self.on_error = on_error
+        self.on_done = on_done
+        self.end = end
+        self.window = window
+        self.poll_interval = poll_interval
+        #Follow the last irreversible block instead of the head block.
+        self.irreversible = irreversible
+        self.next_fetch = start
+        self.next_deliver = start
+        self.released = start
+        #Blocks that arrived ahead of an earlier block still in flight
+        self.arrived = dict()
+        self.head = None
+        self.last_poll = 0.0
+        self.poll_pending = False
+        self.stopped = False
+    def start(self):
+        """Start streaming, beginning with a head poll"""
+        self._poll()
+    def stop(self):
+        """Stop fetching and delivering blocks"""
+        self.stopped = True
+    def release(self, count=1):
+        """A delivered block was consumed, make room in the window"""
+        self.released += count
+        self._fill()
+    def _poll(self):
+        self.poll_pending = True
+        self.last_poll = time.time()
+        def on_props(props):
+            """Update the head and fetch the blocks up to it"""
+            self.poll_pending = False
+            if self.irreversible:
+                self.head = props["last_irreversible_block_num"]
+            else:
+                self.head = props["head_block_number"]
+            self._fill()
+        def on_fail(exception):
+            """Report the error and poll again later"""
+            self.poll_pending = False
+            self._error(None, exception)
+            self._schedule_poll()
+        if not self.stopped:
+            self.portable.set_callbacks(self.queue.condenser_api.get_dynamic_global_properties(),
+                                        on_props, on_fail)
+    def _schedule_poll(self):
+        if self.poll_pending or self.stopped:
+            return
+        self.poll_pending = True
+        #Poll right away if the last poll was longer than an interval ago (long backfill).
+        delay = max(0.0, self.last_poll + self.poll_interval - time.time())
+        self.portable.callLater(delay, self._poll)
+    def _error(self, block_num, exception):
+        if self.on_error is not None:
+            self.on_error(block_num, exception)
+    def _limit(self):
+        if self.end is None:
+            return self.head
+        return min(self.head, self.end)
+    def _fill(self):
+        if self.stopped or self.head is None:
+            return
+        limit = self._limit()
+        while self.next_fetch <= limit and self.next_fetch - self.released < self.window:
+            self._fetch(self.next_fetch)
+            self.next_fetch += 1
+        if self.next_fetch > self.head and (self.end is None or self.next_fetch <= self.end):
+            #Caught up with the head, wait for new blocks.
+            self._schedule_poll()
+    def _fetch(self, block_num):
+        def on_result(result):
+            """Keep the block, deliver what can be delivered in order"""
+            block = result.get("block") if isinstance(result, dict) else None
+            if block is None:
+                #Not there yet on the node that answered, try again later.
+                self.portable.callLater(self.poll_interval, self._refetch, block_num)
+                return
+            self.arrived[block_num] = block
+            self._deliver()
+        def on_fail(exception):
+            """Report the error and fetch the block again later"""
+            self._error(block_num, exception)
+            self.portable.callLater(self.poll_interval, self._refetch, block_num)
+        self.portable.set_callbacks(self.queue.block_api.get_block(block_num=block_num),
+                                    on_result, on_fail)
+    def _refetch(self, block_num):
+        if not self.stopped:
+            self._fetch(block_num)
+    def _deliver(self):
+        while not self.stopped and self.next_deliver in self.arrived:
+            block_num = self.next_deliver
+            self.next_deliver += 1
+            self.on_block(block_num, self.arrived.pop(block_num))
+        if self.end is not None and self.next_deliver > self.end and not self.stopped:
+            self.stopped = True
+            if self.on_done is not None:
+                self.on_done()
@@ -1,64 +1,267 @@
 """Shared code between WildcardQue implementations for asyncio and twisted"""
+import json
+import time
+from collections import deque
+from txjsonrpcqueue.core.codec import encode_params
+
+def coalesce_key(method, params):
+    """Key identifying identical calls: method plus canonicalised params"""
+    return (method, json.dumps(params, sort_keys=True, separators=(",", ":")))
+
+class Task(object):
+    """A queued command: method, params and the deferred or future (fod) for its result.
+
+    Slotted, as there may be tens of thousands of these in a queue.
+    """
+    #pylint: disable=too-few-public-methods
+    __slots__ = ("method", "params", "encoded", "fod", "followers", "deadline", "lane",
+                 "retries", "merged", "parked")
+    def __init__(self, method, params, lane=None):
+        self.method = method
+        self.params = params
+        #Encoded ',"params":...' fragment, or None if the forwarder should encode it
+        self.encoded = None
+        self.fod = None
+        #Deferreds or futures of coalesced identical calls
+        self.followers = None
+        #Absolute time.time() deadline
+        self.deadline = None
+        self.lane = lane
+        self.retries = 0
+        #Calls of a merged command, see CallMerger, False for calls not to merge again
+        self.merged = None
+        #Waiting for room in a queue with backpressure
+        self.parked = False
 
 class WildcardMethod(object):
-    """Wildcard method shared code with namespace support."""
+    """Wildcard method shared code with namespace support.
+
+    ops is the framework specific (deferred or future) implementation of the
+    operations needed on the result placeholder of a queued task. The call functions
+    for inner names are cached on the instance, WildcardQueue caches the instances.
+    """
     #pylint: disable=too-few-public-methods
-    def __init__(self, outername, outer, set_future_or_deferred, set_error_on_future_or_deferred):
+    def __init__(self, outername, outer, ops):
         self.outername = outername
         self.outer = outer
-        self.set_future_or_deferred = set_future_or_deferred
-        self.set_error_on_future_or_deferred = set_error_on_future_or_deferred
+        self.ops = ops
+        #(namespace, call function) for calls in the default namespace of outer
+        self.default = (None, None)
     def __getattr__(self, innername):
+        if innername.startswith("__"):
+            raise AttributeError(innername)
+        ops = self.ops
+        outer = self.outer
+        outername = self.outername
+        if outername:
+            method = outername + "." + innername
+        else:
+            method = innername
         def _core(*args, **kwargs):
-            ttask = dict()
-            if self.outername:
-                ttask["method"] = self.outername + "." + innername
-            else:
-                ttask["method"] = innername
-            if kwargs:
-                ttask["params"] = kwargs
-            else:
-                ttask["params"] = list(args)
-            self.set_future_or_deferred(ttask)
-            put_ok = self.outer.core.put(ttask)
-            if not put_ok:
-                self.set_error_on_future_or_deferred(ttask,
-                                                     BufferError(
-                                                         "No more room left in WildcardQueue"))
-            if "deferred" in ttask:
-                return ttask["deferred"]
-            return ttask["future"]
+            deadline = kwargs.pop("_deadline", outer.default_deadline) if kwargs else \
+                outer.default_deadline
+            lane = kwargs.pop("_lane", None) if kwargs else None
+            if lane is None and outer.namespace_lanes:
+                #Lane by full method name or by namespace
+                lane = outer.namespace_lanes.get(method, outer.namespace_lanes.get(outername))
+            ttask = Task(method, kwargs if kwargs else list(args), lane)
+            key = None
+            store = None
+            cache = outer.cache
+            if cache is not None and cache.cacheable(method):
+                #Serve from the response cache without touching the network if we can.
+                key = coalesce_key(method, ttask.params)
+                hit, result = cache.lookup(key)
+                if hit:
+                    return ops.resolved(result)
+                def store(result):
+                    """Store the result once it comes in"""
+                    cache.store(key, ttask.params, result)
+            coalesced = outer.coalesced
+            if coalesced is not None:
+                #Coalescing: attach to an identical call that is still queued or in flight.
+                if key is None:
+                    key = coalesce_key(method, ttask.params)
+                if key in coalesced:
+                    shared = coalesced[key]
+                    if shared.deadline is not None:
+                        #The shared command is only out of time once all of its callers are.
+                        shared.deadline = None if deadline is None else \
+                            max(shared.deadline, time.time() + deadline)
+                    return ops.follow(shared, deadline=deadline)
+            #Encode the params now, so the forwarder only needs to join byte strings.
+            ttask.encoded = encode_params(outer.dumps, ttask.params)
+            #Cancelling the call lets the queue know, so it can free the slot of the call.
+            ops.set(ttask, outer.canceller if lane is None else
+                    outer.cancellers.get(lane, outer.canceller))
+            if deadline is not None:
+                #Fail the call once its deadline passes, the queue will skip it from then on.
+                ttask.deadline = time.time() + deadline
+                if coalesced is None:
+                    ops.expire_later(ttask, deadline, outer.core.abandon)
+            if store is not None:
+                ops.watch(ttask, store)
+            rval = None
+            if coalesced is not None:
+                coalesced[key] = ttask
+                def done():
+                    """Identical calls from now on should go to the node again"""
+                    del coalesced[key]
+                #Coalesced callers expire on their own deadlines.
+                rval = ops.follow(ttask, done, deadline)
+            queued = outer.core.put(ttask)
+            if queued is False:
+                ops.set_error(ttask, BufferError("No more room left in WildcardQueue"))
+            elif queued is None and outer.max_wait is not None:
+                #Parked in a full queue with backpressure, fail if it waits too long for room.
+                ops.expire_later(ttask, outer.max_wait, outer.core.give_up, True)
+            if rval is None:
+                rval = ops.get(ttask)
+            return rval
+        #Later lookups of innername find the function without calling __getattr__.
+        self.__dict__[innername] = _core
         return _core
     def __call__(self, *args, **kwargs):
-        return self.outer.__getattr__(
-            self.outer.namespace).__getattr__(self.outername)(*args, **kwargs)
+        namespace, call = self.default
+        if call is None or namespace != self.outer.namespace:
+            namespace = self.outer.namespace
+            call = getattr(self.outer.proxy(namespace), self.outername)
+            self.default = (namespace, call)
+        return call(*args, **kwargs)
+
+def bulk_caller(queue, method):
+    """Function calling method on queue with one item of a bulk params iterable.
+
+    A tuple item gives positional params, a dict item gives named params and any
+    other item (a block number, a list of account names) is the single param.
+    """
+    namespace, _, name = method.rpartition(".")
+    if namespace:
+        func = getattr(getattr(queue, namespace), name)
+    else:
+        #Default namespace of the queue
+        func = getattr(queue, name)
+    def call(params):
+        if isinstance(params, tuple):
+            return func(*params)
+        if isinstance(params, dict):
+            return func(**params)
+        return func(params)
+    return call
+
+class CoreBulk(object):
+    """Ordered bulk call of one method over an iterable of params, at most window at a time.
+
+    Params are only taken from the iterable and put in the queue as earlier results
+    are consumed, so memory use does not depend on the length of the iterable.
+    """
+    def __init__(self, call, params_iterable, window):
+        if window < 1:
+            raise ValueError("Bulk window should be at least one")
+        self.call = call
+        self.params = iter(params_iterable)
+        self.window = window
+        #Deferreds or futures of submitted commands, in input order.
+        self.pending = deque()
+        self.exhausted = False
+    def fill(self, window=None):
+        """Submit commands until window of them, by default the bulk window, are pending"""
+        if window is None:
+            window = self.window
+        while not self.exhausted and len(self.pending) < window:
+            try:
+                params = next(self.params)
+            except StopIteration:
+                self.exhausted = True
+                break
+            self.pending.append(self.call(params))
+    def next(self):
+        """The deferred or future of the next result in input order, None when done"""
+        self.fill()
+        if not self.pending:
+            return None
+        head = self.pending.popleft()
+        #Keep the window full while the head is waited on, the head counts as pending.
+        self.fill(self.window - 1)
+        return head
+    def close(self):
+        """Stop submitting, returns the deferreds or futures that were not consumed"""
+        self.exhausted = True
+        rval = list(self.pending)
+        self.pending.clear()
+        return rval
 
 class CoreWildcardQueue(object):
-    """Simple Twisted based hysteresis queue"""
+    """Simple Twisted based hysteresis queue.
+
+    With backpressure, entries put while the queue is disabled are parked instead of
+    dropped. Once the queue drains to its low watermark, parked entries are moved to
+    the queue in the order they were put, until it reaches its high watermark again.
+    Room waiters, tasks without a method, are parked the same way and woken in turn.
+    """
     #pylint: disable=too-many-instance-attributes
-    def __init__(self, soon, low, high, highwater, lowwater):
+    def __init__(self, soon, low, high, highwater, lowwater, skip=None, backpressure=False,
+                 wake=None):
         #pylint: disable=too-many-arguments
         self.soon = soon
+        #Optional predicate for entries that should no longer be sent (expired or cancelled)
+        self.skip = skip
+        self.backpressure = backpressure
+        #Resolves the placeholder of a room waiter once it is its turn
+        self.wake = wake
+        #Entries and room waiters waiting for room, in FIFO order
+        self.parked = deque()
         self.low = low
         self.high = high
         self.active = True
         self.highwater = highwater
         self.lowwater = lowwater
-        self.msg_queue = list()
-        self.fetch_msg_queue = list()
+        #Deques give us O(1) appends and pops at both ends.
+        self.msg_queue = deque()
+        self.fetch_msg_queue = deque()
         self.dropcount = 0
         self.okcount = 0
+        #Totals since creation, for metrics (the counts above reset at watermark events).
+        self.dropped = 0
+        self.enqueued = 0
+        #Cancelled or expired entries that may still be in msg_queue
+        self.abandoned = 0
+        #Cancelled or expired entries dropped from msg_queue since creation, for metrics.
+        self.abandoned_total = 0
     def put(self, entry):
-        """Add entry to the queue, returns boolean indicating success
+        """Add entry to the queue, returns boolean indicating success, or None if the entry
+        was parked by a queue with backpressure.
         will invoke callLater if there is a callback pending for the consumer handler."""
-        #Return false imediately if inactivated dueue to hysteresis setting.
-        if self.active is False:
+        #Parked entries go first, so a disabled queue or one still unparking takes no new ones.
+        if self.active is False or self.parked:
+            if self.backpressure:
+                entry.parked = True
+                self.parked.append(entry)
+                return None
+            #Return false imediately if inactivated dueue to hysteresis setting.
             self.dropcount += 1
+            self.dropped += 1
             return False
+        return self._enqueue(entry)
+    def room(self, waiter):
+        """Wake the room waiter task right away if the queue takes entries, or park it"""
+        if self.active is False or self.parked:
+            waiter.parked = True
+            self.parked.append(waiter)
+        else:
+            self.soon(self.wake, waiter)
+    def give_up(self, lane=None):
+        """A parked entry waited too long for room, it counts as dropped"""
+        #pylint: disable=unused-argument
+        self.dropcount += 1
+        self.dropped += 1
+        self.abandon()
+    def _enqueue(self, entry):
         self.okcount += 1
+        self.enqueued += 1
         try:
             #See if there is a callback waiting already
-            deferred_get = self.fetch_msg_queue.pop(0)
+            deferred_get, _ = self.fetch_msg_queue.popleft()
         except IndexError:
             deferred_get = None
         if deferred_get:
@@ -73,33 +276,207 @@ class CoreWildcardQueue(object):
                 # Queue is full now (high watermark, disable adding untill empty.
                 self.active = False
                 #Call handler of high/low watermark events on earliest opportunity
-                self.soon(self.highwater, self.okcount)
+                if self.highwater:
+                    self.soon(self.highwater, self.okcount)
                 self.okcount = 0
             return True
     def again(self, batch):
-        self.msg_queue = batch + self.msg_queue
+        """Requeue a batch at the front of the queue, preserving its order. O(len(batch))"""
+        self.msg_queue.extendleft(reversed(batch))
+        #Hand the requeued entries to consumers that were waiting on an empty queue.
+        while self.fetch_msg_queue and self.msg_queue:
+            deferred_get, maxbatch = self.fetch_msg_queue.popleft()
+            self.get(deferred_get, maxbatch)
+    def abandon(self, lane=None):
+        """An entry was cancelled or expired, it may still be waiting in the queue.
+
+        Abandoned entries are dropped when they come up in take. Once they could make up
+        half of the queue, or could bring a disabled queue down to its low watermark, the
+        queue is compacted right away, freeing their slots. lane is the lane of the entry,
+        for CoreLaneQueue.
+        """
+        #pylint: disable=unused-argument
+        self.abandoned += 1
+        if self.skip is None:
+            return
+        if 2 * self.abandoned > len(self.msg_queue) + len(self.parked) or \
+                (self.active is False and len(self.msg_queue) - self.abandoned <= self.low):
+            self.compact()
+    def compact(self):
+        """Drop the entries that should no longer be sent from the queue. O(len(queue))"""
+        entries = list(self.msg_queue)
+        self.msg_queue.clear()
+        self.abandoned = 0
+        #The skip predicate may run callbacks that put entries, so append one by one.
+        for entry in entries:
+            if self.skip(entry):
+                self.abandoned_total += 1
+            else:
+                self.msg_queue.append(entry)
+        if self.parked:
+            parked = list(self.parked)
+            self.parked.clear()
+            for entry in parked:
+                if not self.skip(entry):
+                    self.parked.append(entry)
+        self._check_low()
+    def take(self, maxbatch):
+        """Take up to maxbatch entries from the queue right now, possibly none"""
+        popleft = self.msg_queue.popleft
+        if self.skip is None:
+            rbatch = [popleft() for _ in range(min(maxbatch, len(self.msg_queue)))]
+        else:
+            #Drop entries that should no longer be sent while assembling the batch.
+            rbatch = list()
+            while self.msg_queue and len(rbatch) < maxbatch:
+                entry = popleft()
+                if not self.skip(entry):
+                    rbatch.append(entry)
+                else:
+                    self.abandoned_total += 1
+                    if self.abandoned:
+                        self.abandoned -= 1
+        self._check_low()
+        return rbatch
+    def _check_low(self):
+        if self.active is False and len(self.msg_queue) <= self.low:
+            #If adding to the queue was disabled and we just dropped below the low water mark,
+            # re-enable the queue now.
+            self.active = True
+            #Call handler of high/low watermark events on earliest opportunity
+            if self.lowwater:
+                self.soon(self.lowwater, self.dropcount)
+            self.dropcount = 0
+        if self.parked and self.active:
+            self._unpark()
+    def _unpark(self):
+        #Move parked entries to the queue in FIFO order until it is full again.
+        while self.parked and self.active:
+            entry = self.parked.popleft()
+            #Out of the parked line, max wait no longer applies.
+            entry.parked = False
+            if self.skip is not None and self.skip(entry):
+                continue
+            if entry.method is None:
+                self.soon(self.wake, entry)
+            else:
+                self._enqueue(entry)
     def get(self, deferred_get, maxbatch):
         """Fetch an entry from the queue, imediately if possible, or remember callback for when an
            entry becomes available."""
-        rbatch = list()
-        rval = True
-        while rval and len(rbatch) < maxbatch:
-            try:
-                #See if we can fetch a value from the queue right now.
-                rval = self.msg_queue.pop(0)
-                rbatch.append(rval)
-            except IndexError:
-                rval = None
+        #See if we can fetch up to maxbatch values from the queue right now.
+        rbatch = self.take(maxbatch)
         if rbatch:
             #If we can, call callback at earliest opportunity
             self.soon(deferred_get.callback, rbatch)
-            if self.active is False and len(self.msg_queue) <= self.low:
-                #If adding to the queue was disabled and we just dropped below the low water mark,
-                # re-enable the queue now.
-                self.active = True
-                #Call handler of high/low watermark events on earliest opportunity
-                self.soon(self.lowwater, self.dropcount)
-                self.dropcount = 0
         else:
             # If the queue was empty, add our callback to the callback queue
-            self.fetch_msg_queue.append(deferred_get)
+            self.fetch_msg_queue.append((deferred_get, maxbatch))
+
+def _lane_callback(callback, name):
+    """With lanes, high/low watermark handlers also get the name of the lane"""
+    if callback is None:
+        return None
+    def lane_callback(count):
+        callback(count, name)
+    return lane_callback
+
+class CoreLaneQueue(object):
+    """Priority lanes, each a CoreWildcardQueue with its own hysteresis and counters.
+
+    Lanes are listed highest priority first, the first lane is the default lane.
+    Without weights get() dequeues in strict priority order, with weights it uses
+    smooth weighted round robin over the lanes that have entries.
+    """
+    #pylint: disable=too-many-instance-attributes
+    def __init__(self, soon, lanes, low, high, highwater, lowwater, skip=None, weights=None,
+                 watermarks=None, backpressure=False, wake=None):
+        #pylint: disable=too-many-arguments
+        self.soon = soon
+        self.order = list(lanes)
+        self.weights = weights
+        self.lanes = dict()
+        self.credit = dict()
+        for name in self.order:
+            lane_low, lane_high = (watermarks or dict()).get(name, (low, high))
+            self.lanes[name] = CoreWildcardQueue(soon, lane_low, lane_high,
+                                                 _lane_callback(highwater, name),
+                                                 _lane_callback(lowwater, name), skip,
+                                                 backpressure, wake)
+            self.credit[name] = 0
+        self.fetch_msg_queue = deque()
+    def _lane(self, entry):
+        name = entry.lane or self.order[0]
+        if name not in self.lanes:
+            raise ValueError("No lane named " + str(name) + " in WildcardQueue")
+        return self.lanes[name]
+    def put(self, entry):
+        """Add entry to its lane, returns boolean indicating success, or None if parked"""
+        queued = self._lane(entry).put(entry)
+        if queued:
+            self._serve()
+        return queued
+    def room(self, waiter):
+        """Wake the room waiter task once the lane it is for takes entries"""
+        self._lane(waiter).room(waiter)
+    def give_up(self, lane=None):
+        """A parked entry of lane waited too long for room, see CoreWildcardQueue.give_up"""
+        #No such lane if the put of the entry failed with ValueError.
+        if (lane or self.order[0]) in self.lanes:
+            self.lanes[lane or self.order[0]].give_up()
+            self._serve()
+    def abandon(self, lane=None):
+        """An entry of lane was cancelled or expired, see CoreWildcardQueue.abandon"""
+        if (lane or self.order[0]) in self.lanes:
+            self.lanes[lane or self.order[0]].abandon()
+            #Compacting may have unparked entries for consumers waiting on empty lanes.
+            self._serve()
+    def again(self, batch):
+        """Requeue a batch at the front of the lanes its entries came from"""
+        groups = dict()
+        for entry in batch:
+            groups.setdefault(entry.lane or self.order[0], list()).append(entry)
+        for name, entries in groups.items():
+            self.lanes[name].again(entries)
+        self._serve()
+    def take(self, maxbatch):
+        """Take up to maxbatch entries from the lanes right now, possibly none"""
+        rbatch = list()
+        if self.weights is None:
+            #Strict priority
+            for name in self.order:
+                rbatch.extend(self.lanes[name].take(maxbatch - len(rbatch)))
+                if len(rbatch) >= maxbatch:
+                    break
+            return rbatch
+        while len(rbatch) < maxbatch:
+            #Smooth weighted round robin over the non-empty lanes.
+            names = [name for name in self.order if self.lanes[name].msg_queue]
+            if not names:
+                break
+            total = 0
+            for name in names:
+                weight = self.weights.get(name, 1)
+                self.credit[name] += weight
+                total += weight
+            best = max(names, key=self.credit.get)
+            self.credit[best] -= total
+            rbatch.extend(self.lanes[best].take(1))
+        return rbatch
+    def get(self, deferred_get, maxbatch):
+        """Fetch entries from the lanes, imediately if possible, or remember callback for when
+           an entry becomes available."""
+        rbatch = self.take(maxbatch)
+        if rbatch:
+            self.soon(deferred_get.callback, rbatch)
+        else:
+            self.fetch_msg_queue.append((deferred_get, maxbatch))
+    def _serve(self):
+        #Hand new entries to consumers that were waiting on empty lanes.
+        while self.fetch_msg_queue:
+            deferred_get, maxbatch = self.fetch_msg_queue[0]
+            rbatch = self.take(maxbatch)
+            if not rbatch:
+                break
+            self.fetch_msg_queue.popleft()
+            self.soon(deferred_get.callback, rbatch)
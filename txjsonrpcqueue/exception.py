@@ -43,3 +43,6 @@ class JsonRpcCommandResponseError(Exception):
     def __init__(self, message, obj):
         super(JsonRpcCommandResponseError, self).__init__(message)
         self.obj = obj
+
+class DeadlineExceeded(Exception):
+    """The deadline of a command, or the timeout of its batch, passed before a response"""
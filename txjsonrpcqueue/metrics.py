@@ -0,0 +1,25 @@
+"""Twisted Prometheus endpoint for a MetricsRegistry"""
+from twisted.internet import reactor
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+class MetricsResource(Resource):
+    """twisted.web resource serving the metrics in the Prometheus text format"""
+    #pylint: disable=invalid-name
+    isLeaf = True
+    def __init__(self, registry):
+        Resource.__init__(self)
+        self.registry = registry
+    def render_GET(self, request):
+        """render_GET"""
+        request.setHeader(b"Content-Type", b"text/plain; version=0.0.4; charset=utf-8")
+        return self.registry.prometheus().encode("utf8")
+
+def listen_metrics(registry, port=9100, interface="127.0.0.1"):
+    """Serve the metrics on http://interface:port/ , returns the listening port.
+
+    The metrics show node URLs and queue internals, so only local scrapers see them unless
+    an other interface, like "" for all of them, is given.
+    """
+    #pylint: disable=no-member
+    return reactor.listenTCP(port, Site(MetricsResource(registry)), interface=interface)
@@ -0,0 +1,58 @@
+"""Twisted variant of the local mock Steem JSON-RPC node"""
+import json
+from twisted.internet import reactor
+from twisted.web.resource import Resource
+from twisted.web.server import Site, NOT_DONE_YET
+from txjsonrpcqueue.core.mocknode import decode_body
+
+class MockNodeResource(Resource):
+    """twisted.web resource answering JSON-RPC batches with a core MockNode"""
+    #pylint: disable=invalid-name
+    isLeaf = True
+    def __init__(self, node):
+        Resource.__init__(self)
+        self.node = node
+    def render_POST(self, request):
+        """render_POST"""
+        encoding = request.getHeader(b"Content-Encoding")
+        body = decode_body(request.content.read(),
+                           None if encoding is None else encoding.decode("latin1"))
+        if body is None:
+            request.setResponseCode(415)
+            return b"Unsupported Content-Encoding"
+        status, body = self.node.handle(body)
+        length = self.node.content_length(body)
+        def respond():
+            """Write the (possibly delayed) response"""
+            if request.finished or getattr(request, "_disconnected", False):
+                return
+            request.setResponseCode(status)
+            request.setHeader(b"Content-Type", b"application/json")
+            request.setHeader(b"Content-Length", str(length).encode())
+            request.write(body)
+            if length > len(body):
+                #Truncated, drop the connection mid-body.
+                request.transport.loseConnection()
+                return
+            request.finish()
+        delay = self.node.delay()
+        if delay > 0:
+            #pylint: disable=no-member
+            reactor.callLater(delay, respond)
+        else:
+            respond()
+        return NOT_DONE_YET
+    def render_GET(self, request):
+        """render_GET, the stats of the mock node"""
+        request.setHeader(b"Content-Type", b"application/json")
+        return json.dumps(self.node.stats).encode()
+
+def listen_mock_node(node, port=0, interface="127.0.0.1"):
+    """Serve a MockNode on http://interface:port/ , returns the listening port.
+
+    With port 0 a free port is picked, listening_port.getHost().port tells which.
+    """
+    #pylint: disable=no-member
+    site = Site(MockNodeResource(node))
+    site.noisy = False
+    return reactor.listenTCP(port, site, interface=interface)
@@ -1,17 +1,30 @@
 """Asyncio RpcForwarder implementation"""
 #pylint: disable=missing-docstring
-import json
+import time
 import OpenSSL
 from service_identity.exceptions import VerificationError
 from service_identity.exceptions import DNSMismatch
 from twisted.python import log
-from twisted.web.client import Agent, readBody
+from twisted.web.client import Agent, HTTPConnectionPool, ResponseDone
+from twisted.web.client import ContentDecoderAgent, GzipDecoder
+from twisted.web.http import PotentialDataLoss
 from twisted.web.http_headers import Headers
-from twisted.web.client import ResponseFailed
+from twisted.web.client import ResponseFailed, ResponseNeverReceived
+from twisted.internet.error import ConnectError, ConnectionClosed
 from twisted.internet import reactor, defer
-from txjsonrpcqueue.exception import HttpServerError, HttpClientError, JsonRpcBatchError
-from txjsonrpcqueue.exception import JsonRpcCommandError, JsonRpcCommandResponseError
-from txjsonrpcqueue.exception import SSLNameMismatch, SSLError
+from twisted.internet.protocol import Protocol
+from txjsonrpcqueue.exception import HttpServerError, HttpClientError
+from txjsonrpcqueue.exception import SSLNameMismatch, SSLError, DeadlineExceeded
+from txjsonrpcqueue.core.batchsize import AdaptiveBatchSize
+from txjsonrpcqueue.core.codec import get_codec, BatchEncoder
+from txjsonrpcqueue.core.compression import Compression
+from txjsonrpcqueue.core.balancer import NodeBalancer
+from txjsonrpcqueue.core.rpcforwarder import CoreBatch, StreamingBatchParser
+from txjsonrpcqueue.core.rpcforwarder import batch_timeout, unexpired
+
+#Extra command for single command batches, encoded once
+_BOGUS_CMD = b'{"jsonrpc":"2.0","method":"bogus_api.bogus_method","params":["Extra bogus API ' \
+             b'call for making sure the server supports batches of bigger than one."],"id":0}'
 
 #Simple helper class for JSON-RPC response storage
 class _StringProducer(object):
@@ -32,19 +45,148 @@ class _StringProducer(object):
         """dummy stopProducing, does nothing"""
         pass
 
+class _StreamingBodyProtocol(Protocol):
+    """Helper class, feeds the response body to a StreamingBatchParser as it arrives"""
+    #pylint: disable=invalid-name
+    def __init__(self, parser, deferred):
+        self.parser = parser
+        self.deferred = deferred
+    def dataReceived(self, data):
+        """dataReceived"""
+        self.parser.feed(data)
+    def connectionLost(self, reason=None):
+        """connectionLost, fires the deferred with the parser once the body is complete"""
+        if self.deferred.called:
+            #Cancelled
+            return
+        if reason.check(ResponseDone, PotentialDataLoss):
+            #Without a Content-Length the parser tells us if the body is complete.
+            self.deferred.callback(self.parser)
+        else:
+            self.deferred.errback(reason)
+
+def _read_body(response, parser):
+    """Like readBody, but parsing the body while it comes in"""
+    def cancel(deferred):
+        #pylint: disable=unused-argument
+        #The transport is a producer proxy here, stopping it closes the connection,
+        # so it won't go back to the pool with the rest of the body still coming in.
+        if protocol.transport is not None:
+            protocol.transport.stopProducing()
+    deferred = defer.Deferred(cancel)
+    protocol = _StreamingBodyProtocol(parser, deferred)
+    response.deliverBody(protocol)
+    return deferred
+
+def _tx_resolve(task, result):
+    #The first response for a command wins, later ones (hedged copies) are discarded.
+    if not task.fod.called:
+        task.fod.callback(result)
+
+def _tx_fail(task, exception):
+    if not task.fod.called:
+        task.fod.errback(exception)
+
+def _tx_unwrap_failure(failure):
+    """Turn a request failure into the exception to spread over the batch commands"""
+    #pylint: disable=broad-except
+    try:
+        failure.raiseException()
+    except (ResponseFailed, ResponseNeverReceived) as exception:
+        failure2 = exception.reasons[0]
+        try:
+            failure2.raiseException()
+        except VerificationError as exception2:
+            error = exception2.errors[0]
+            if isinstance(error, DNSMismatch):
+                return SSLNameMismatch("Problem with node certificate. Wrong DNS name.")
+            return SSLError("Problem with node certificate.")
+        except OpenSSL.SSL.Error as exception2:
+            return SSLError("Problem with node certificate.")
+        except Exception as exception2:
+            return exception2
+    except Exception as exception:
+        return exception
+
+#Framework specific batch level exceptions worth a retry
+_TX_TRANSIENT = (ConnectError, ConnectionClosed, ResponseNeverReceived)
+
+class ConnectionPool(HTTPConnectionPool):
+    """Persistent (keep-alive) HTTP connection pool, may be shared between forwarders"""
+    #pylint: disable=too-few-public-methods
+    def __init__(self, limit_per_host=10, idle_timeout=60.0):
+        HTTPConnectionPool.__init__(self, reactor, persistent=True)
+        #Maximum number of idle connections kept open per host.
+        self.maxPersistentPerHost = limit_per_host #pylint: disable=invalid-name
+        #Idle connections get closed after this many seconds.
+        self.cachedConnectionTimeout = idle_timeout #pylint: disable=invalid-name
+    def close(self):
+        """Close all idle connections, returns a deferred"""
+        return self.closeCachedConnections()
+
 class RpcForwarder:
-    # pylint: disable=too-few-public-methods
-    def __init__(self, queue, host_injector=None, host_url=None):
+    # pylint: disable=too-few-public-methods,too-many-instance-attributes
+    def __init__(self, queue, host_injector=None, host_url=None, max_inflight=1, pool=None,
+                 batch_size=None, hedge=None, timeout=None, retry=None, codec=None, stream=True,
+                 compression=None, metrics=None, recorder=None, merger=None):
+        #pylint: disable=too-many-arguments
         if host_injector is None and host_url is None:
             raise RuntimeError("Constructor requires either host_injector or host_url to be set.")
         if host_injector and host_url:
             raise RuntimeError("Either host_injector or host_url should be specified, not both")
         self.queue = queue
-        self.maxbatch = 10
-        self.cmd_id = 0
+        #Per host adaptive batch size controller, may be shared between forwarders.
+        if batch_size is None:
+            batch_size = AdaptiveBatchSize()
+        self.batch_size = batch_size
+        #Optional HedgePolicy for re-sending slow batches to a second node.
+        self.hedge = hedge
+        #Default HTTP timeout for a batch, tightened by the deadlines of its commands.
+        self.timeout = timeout
+        #Optional RetryPolicy for batches failing with a transient error.
+        self.retry = retry
+        #JSON codec for batch encoding and decoding, the fastest one installed by default.
+        if codec is None or isinstance(codec, str):
+            codec = get_codec(codec)
+        self.codec = codec
+        self.encoder = BatchEncoder(codec)
+        #Parse batch responses while they come in, resolving each command as early as possible.
+        self.stream = stream
+        #Response decompression and optional request body compression.
+        if compression is None:
+            compression = Compression()
+        self.compression = compression
+        #Optional MetricsRegistry, commands failing in our batches get counted there.
+        self.metrics = metrics
+        #Optional Recorder, appends every posted batch and its raw response to a capture file.
+        self.recorder = recorder
+        #Optional CallMerger, merges calls to list-taking methods within a batch.
+        self.merger = merger
+        self.fail = _tx_fail
+        if metrics is not None:
+            self.fail = metrics.counting_fail(_tx_fail)
+            metrics.add_queue(queue)
+            metrics.add_forwarder(self)
+            if getattr(host_injector, "fnod", None) is not None:
+                metrics.add_nodes(host_injector.fnod)
         self.started = False
+        #The number of batches we keep posted to the host at any one time.
+        self.max_inflight = max_inflight
+        #Number of running fetch/post loops
+        self.loops = 0
+        #Healthy nodes injected by the host injector, used for balancing and hedging.
+        self.balancer = NodeBalancer()
+        self.balanced = False
+        #If no (shared) connection pool is given, we own a pool sized for our inflight window.
+        self.own_pool = pool is None
+        if pool is None:
+            pool = ConnectionPool(limit_per_host=max(max_inflight, 2))
+        self.pool = pool
         #For the twisted implementation we build on twisted.web.client.Agent
-        self.agent = Agent(reactor)
+        self.agent = Agent(reactor, pool=self.pool)
+        if self.compression.accept:
+            #Negotiate gzip compressed responses, decoded before they reach the body parser.
+            self.agent = ContentDecoderAgent(self.agent, [(b"gzip", GzipDecoder)])
         if host_injector:
             #Register ourselves with the host injector object. Don't start yet untill the host
             # injector injects us with an initial host.
@@ -57,7 +199,7 @@ class RpcForwarder:
             else:
                 self.host_url = host_url.encode("utf8")
             log.msg("RpcForwarder __init__: Starting up for " + self.host_url.decode("utf8"))
-            self._fetch_batch()
+            self._start()
     def inject_host_url(self, url):
         #Set the host url to its new value
         if isinstance(url, bytes):
@@ -68,146 +210,232 @@ class RpcForwarder:
         #If we weren't started yet, start fetching batches now.
         if not self.started:
             log.msg("RpcForwarder inject_host_url: Starting up for " + self.host_url.decode("utf8"))
+            self._start()
+    def inject_host_set(self, nodes, balanced=True):
+        """Set of healthy nodes (map from URL to speed) to hedge to, and if balanced,
+           to spread batches over"""
+        if not nodes:
+            return
+        self.balancer.set_nodes(nodes)
+        self.balanced = balanced
+        if not self.started:
+            #Start up on the fastest node of the set.
+            self.inject_host_url(min(nodes, key=nodes.get))
+        else:
+            self._spawn_loops()
+    @property
+    def maxbatch(self):
+        """Current batch size for the current host"""
+        return self.batch_size.get(self.host_url.decode("utf8"))
+    def batch_sizes(self):
+        """Current batch size for every host we posted batches to"""
+        return self.batch_size.snapshot()
+    def close(self):
+        """Close the connection pool if we own it, returns a deferred"""
+        if self.own_pool:
+            return self.pool.close()
+        return defer.succeed(None)
+    def _start(self):
+        self.started = True
+        self._spawn_loops()
+    def _target_loops(self):
+        #max_inflight batches per healthy node when balancing, or for the single host.
+        if self.balanced:
+            return self.max_inflight * max(len(self.balancer), 1)
+        return self.max_inflight
+    def _spawn_loops(self):
+        #Start independent fetch/post loops up to the target. Each loop fetches its next batch
+        # as soon as its previous batch completed, so up to max_inflight batches are
+        # posted to a host at any one time. Command ids are numbered per batch, they only
+        # need to be unique within the batch, so loops don't share any id state.
+        while self.loops < self._target_loops():
+            self.loops += 1
             self._fetch_batch()
-    def _process_batch(self, batch_in):
-        #Map from JSON-RPC to future waiting for result
-        deferreds_map = dict()
-        #The outgoing JSON-RPC batch
-        batch_out = list()
-        #Set of unprocessed entries
-        unprocessed = set()
-        def process_batch_level_exception(exception):
-            """Spread batch level exception to each of the batch entries"""
-            #On a batch level exception, forward the cought exception to the future for
-            # each of the commands that are part of the batch.
-            #pylint: disable=unused-variable
-            for key, entry_deferred in deferreds_map.items():
-                entry_deferred.errback(exception)
-        def process_json_parse_error(code, body):
-            """Convert a json parse error and HTTP error code into appropriate exception type"""
-            if code > 499: #5xx server side error codes
-                process_batch_level_exception(HttpServerError(code, body))
-            else:
-                if code > 399: #4xx client side errors.
-                    if code == 413 and self.maxbatch > 1:
-                        self.maxbatch = 1
-                        self.queue.json_rpcqueue_again(batch_in)
-                    else:
-                        process_batch_level_exception(
-                            HttpClientError(code, body))
-                else:
-                    # Non-error code in the 2xx and 3xx range.
-                    process_batch_level_exception(
-                        JsonRpcBatchError(code, body,
-                                          "Invalid JSON returned by server"))
+    def _pick_host(self):
+        #Spread batches over the healthy node set if we are balancing, else use the single host
+        # unless it just failed and there is an other healthy node to fail over to.
+        if self.balanced:
+            node = self.balancer.pick()
+        elif self.balancer.is_penalized(self._host()):
+            node = self.balancer.pick(exclude=self._host())
+        else:
+            node = None
+        if node is None:
+            return self._host()
+        return node
+    def _host(self):
+        return self.host_url.decode("utf8")
+    def _retry(self, batch, host, exception):
+        """Requeue commands of a batch that failed with a transient error, after a backoff"""
+        if self.retry is None or batch.pending != 1 or \
+                not self.retry.transient(exception, _TX_TRANSIENT):
+            return
+        tasks = self.retry.take(batch)
+        if tasks:
+            log.msg("Retrying " + str(len(tasks)) + " commands after failure on " + host)
+            #Avoid the failing host for a while, so the retry can go to an other healthy node.
+            self.balancer.penalize(host, self.retry.penalty)
+            #pylint: disable=no-member
+            reactor.callLater(self.retry.delay(tasks), self.queue.json_rpcqueue_again, tasks)
+    def _post(self, batch, batch_in, host, body, encoding=None):
+        """Post one copy of the batch to a host"""
+        #pylint: disable=too-many-arguments
+        start_time = time.time()
+        #The deferred we are currently waiting for, cancelled if the batch times out.
+        waiting = dict()
+        def cancel():
+            #An other copy of the batch completed it first.
+            waiting["lost"] = True
+            waiting["deferred"].cancel()
+        batch.posted(cancel)
+        self.balancer.start(host)
+        timeout, by_deadline = batch_timeout(batch_in, self.timeout)
+        def on_timeout():
+            waiting["timed_out"] = True
+            waiting["deferred"].cancel()
+        def to_exception(failure):
+            if "timed_out" in waiting:
+                #Batch timed out, requeue commands that still have time left. Only the
+                # forwarder timeout says anything about the node being overloaded.
+                if not by_deadline:
+                    self.batch_size.overload(host)
+                if batch.pending == 1:
+                    self.queue.json_rpcqueue_again(batch.take_unprocessed(
+                        lambda task: unexpired(task, by_deadline)))
+                return DeadlineExceeded("Batch timeout exceeded")
+            return _tx_unwrap_failure(failure)
         def process_response(response):
             code = response.code
-            def process_body(text_result):
-                """Process JSON-RPC batch response body"""
-                #pylint: disable=broad-except, unused-variable
-                try:
-                    #Parse the JSON content of the JSON-RPC batch response.
-                    resp_obj = json.loads(text_result)
-                except json.decoder.JSONDecodeError as exception:
-                    process_json_parse_error(code, text_result.decode())
-                    resp_obj = None
-                if resp_obj:
-                    #Assert the parsed JSON is a list.
-                    if not isinstance(resp_obj, list):
-                        process_batch_level_exception(
-                            JsonRpcBatchError(code, text_result.decode(),
-                                              "Non-batch JSON response from server."))
-                        resp_obj = []
-                    else:
-                        #Process the individual command responses
-                        for response in resp_obj:
-                            #Get the id from the response to match with the apropriate reuest
-                            if "id" in response and response["id"] in unprocessed:
-                                query_id = response["id"]
-                                #Maintain list of unprocessed id's
-                                unprocessed.remove(query_id)
-                                #Look up the proper command future to map this response to.
-                                query_deferred = deferreds_map[query_id]
-                                #Distinguish between responses and errors.
-                                if "result" in response:
-                                    #Set future result
-                                    query_deferred.callback(response["result"])
-                                if (not "result" in response) and "error" in response and \
-                                        "message" in response["error"] and \
-                                        "code" in response["error"] and \
-                                        "data" in response["error"]:
-                                    query_deferred.errback(
-                                        JsonRpcCommandError(response["error"]["code"],
-                                                            response["error"]["message"],
-                                                            response["error"]["data"]))
-                                if (not "result" in response) and (not "error" in response):
-                                    query_deferred.errback(
-                                        JsonRpcCommandResponseError(
-                                            "Bad command response from server", response))
-                        #Work through any request item id not found in the response.
-                        for no_valid_response_id in unprocessed:
-                            query_deferred = deferreds_map[no_valid_response_id]
-                            query_deferred.errback(
-                                JsonRpcCommandResponseError(
-                                    "Request command id not found in response.", resp_obj))
-                self._fetch_batch()
-            #Get (text) content from the server response
-            body_deferred = readBody(response)
-            body_deferred.addCallbacks(process_body, process_batch_level_exception)
-            body_deferred.addBoth(self._fetch_batch)
+            if self.metrics is not None:
+                self.metrics.status(host, code)
+            def process_body(parser):
+                """Process the end of the JSON-RPC batch response body"""
+                latency = time.time() - start_time
+                if self.hedge is not None:
+                    self.hedge.record(latency)
+                resp_obj, exception = parser.finish()
+                if self.recorder is not None:
+                    self.recorder.record(host, start_time, latency, body, code,
+                                         parser.raw_body(), encoding)
+                if self.metrics is not None:
+                    self.metrics.latency(host, latency)
+                    if exception is not None:
+                        self.metrics.batch_error(host, exception)
+                if isinstance(exception, HttpServerError):
+                    self.batch_size.overload(host)
+                if isinstance(exception, HttpClientError) and code == 413 and \
+                        batch.size > 1 and batch.pending == 1:
+                    #Batch too large for the node, shrink batch size and requeue.
+                    self.batch_size.overload(host)
+                    self.queue.json_rpcqueue_again(batch.take_unprocessed())
+                if exception is None:
+                    self.batch_size.success(host, len(batch_in), latency, parser.size)
+                else:
+                    self._retry(batch, host, exception)
+                batch.copy_done(resp_obj, exception)
+            def process_body_failure(failure):
+                if "lost" in waiting:
+                    batch.copy_done()
+                    return
+                exception = to_exception(failure)
+                if self.recorder is not None:
+                    self.recorder.record(host, start_time, time.time() - start_time, body, code,
+                                         encoding=encoding, error=exception)
+                if self.metrics is not None:
+                    self.metrics.batch_error(host, exception)
+                self._retry(batch, host, exception)
+                batch.copy_done(None, exception)
+            #Resolve commands as their responses come in, the rest once the body is complete.
+            body_deferred = _read_body(response, StreamingBatchParser(
+                code, batch.process_response, self.codec.loads, self.stream,
+                self.recorder is not None))
+            waiting["deferred"] = body_deferred
+            body_deferred.addCallbacks(process_body, process_body_failure)
             return body_deferred
-        def process_batch_level_exception_and_continue(failure):
-            try:
-                failure.raiseException()
-            except ResponseFailed as exception:
-                failure2 = exception.reasons[0]
-                try:
-                    failure2.raiseException()
-                except VerificationError as exception2:
-                    error = exception2.errors[0]
-                    if isinstance(error,DNSMismatch):
-                        process_batch_level_exception(SSLNameMismatch("Problem with node certificate. Wrong DNS name."))
-                    else:
-                        process_batch_level_exception(SSLError("Problem with node certificate."))
-                except OpenSSL.SSL.Error as exception2:
-                    process_batch_level_exception(SSLError("Problem with node certificate."))
-                except Exception as exception2:
-                    process_batch_level_exception(exception2)
-            except Exception as exception:
-                process_batch_level_exception(exception)
-            self._fetch_batch()
-        log.msg("Processing new batch for " + self.host_url.decode("utf8") + " , " + str(len(batch_in)))
-        #Build the output batch and deferred map.
-        for cmd in batch_in:
-            self.cmd_id += 1
-            unprocessed.add(self.cmd_id)
-            newcmd = dict()
-            newcmd["id"] = self.cmd_id
-            newcmd["jsonrpc"] = "2.0"
-            newcmd["method"] = cmd["method"]
-            if cmd["params"]:
-                newcmd["params"] = cmd["params"]
-            deferreds_map[self.cmd_id] = cmd["deferred"]
-            batch_out.append(newcmd)
-        #Piggybag extra command onto single command batches. FIXME: this is a temporary workaround.
-        if len(batch_out) == 1 and self.maxbatch > 1:
-            newcmd = dict()
-            newcmd["id"] = 0
-            newcmd["jsonrpc"] = "2.0"
-            newcmd["method"] = "bogus_api.bogus_method"
-            newcmd["params"] = ["Extra bogus API call for making sure the server supports batches of bigger than one."]
-            batch_out.append(newcmd)
+        def process_request_failure(failure):
+            if "lost" in waiting:
+                batch.copy_done()
+                return
+            exception = to_exception(failure)
+            if self.recorder is not None:
+                self.recorder.record(host, start_time, time.time() - start_time, body,
+                                     encoding=encoding, error=exception)
+            if self.metrics is not None:
+                self.metrics.batch_error(host, exception)
+            if not isinstance(exception, (SSLError, DeadlineExceeded)):
+                self.batch_size.overload(host)
+            self._retry(batch, host, exception)
+            batch.copy_done(None, exception)
+        def done(arg=None):
+            #pylint: disable=unused-argument
+            self.balancer.done(host)
+            if timer is not None and timer.active():
+                timer.cancel()
         #Post the JSON-RPC batch request to the server and wait for response
-        log.msg("Posting batch to node " + self.host_url.decode("utf8"))
+        log.msg("Posting batch to node " + host)
+        headers = Headers({b"User-Agent"  : [b'TxJsonRpcQueue v0.0.1'],
+                           b"Content-Type": [b"application/json"]})
+        if encoding is not None:
+            headers.addRawHeader(b"Content-Encoding", encoding.encode("utf8"))
         deferred_response = self.agent.request(
             b'POST',
-            self.host_url,
-            Headers({b"User-Agent"  : [b'TxJsonRpcQueue v0.0.1'],
-                     b"Content-Type": [b"application/json"]}),
-            _StringProducer(json.dumps(batch_out).encode("utf8")))
-        deferred_response.addCallbacks(process_response, process_batch_level_exception_and_continue)
-    def _fetch_batch(self, arg=None):
-        log.msg("Asking queue for a new batch (" + str(self.maxbatch) + ")")
+            host.encode("utf8"),
+            headers,
+            _StringProducer(body))
+        waiting["deferred"] = deferred_response
+        timer = None
+        if timeout is not None:
+            #pylint: disable=no-member
+            timer = reactor.callLater(timeout, on_timeout)
+        deferred_response.addCallbacks(process_response, process_request_failure)
+        deferred_response.addBoth(done)
+    def _hedge_batch(self, batch, batch_in, host, body, encoding=None):
+        """Re-send a batch that is still outstanding to the next-best node"""
+        #pylint: disable=too-many-arguments
+        if batch.completed:
+            return
+        alternate = self.balancer.pick(exclude=host)
+        if alternate is None:
+            return
+        log.msg("Hedging slow batch for " + host + " to " + alternate)
+        self.hedge.hedged += 1
+        self._post(batch, batch_in, alternate, body, encoding)
+    def _process_batch(self, batch_in, host):
+        maxbatch = self.batch_size.get(host)
+        log.msg("Processing new batch for " + host + " , " + str(len(batch_in)))
+        #Drop commands cancelled or expired since the queue handed them out.
+        batch_in = [cmd for cmd in batch_in if not cmd.fod.called]
+        if not batch_in:
+            self._fetch_batch()
+            return
+        batch_out = batch_in if self.merger is None else self.merger.merge(batch_in)
+        #Map from JSON-RPC id, numbered from one within the batch, to task waiting for result
+        tasks = dict(enumerate(batch_out, 1))
+        #Piggybag extra command onto single command batches. FIXME: this is a temporary workaround.
+        # Not once the batch size for the host dropped to one, the node may refuse two commands.
+        extra = _BOGUS_CMD if len(batch_out) == 1 and maxbatch > 1 else None
+        body, encoding = self.compression.encode(self.encoder.encode(batch_out, True, extra))
+        if self.metrics is not None:
+            self.metrics.batch(len(batch_out))
+        #Once every command has its response (from any copy), this loop fetches its next batch.
+        batch = CoreBatch(tasks, _tx_resolve, self.fail, self._fetch_batch, self.merger,
+                          self.queue.json_rpcqueue_again, extra is not None)
+        self._post(batch, batch_in, host, body, encoding)
+        if self.hedge is not None:
+            delay = self.hedge.delay()
+            if delay is not None:
+                #pylint: disable=no-member
+                timer = reactor.callLater(delay, self._hedge_batch, batch, batch_in, host,
+                                          body, encoding)
+                batch.later(lambda: timer.active() and timer.cancel())
+    def _fetch_batch(self):
+        if self.loops > self._target_loops():
+            #The healthy node set shrunk, let this loop end.
+            self.loops -= 1
+            return
+        host = self._pick_host()
+        maxbatch = self.batch_size.get(host)
+        log.msg("Asking queue for a new batch (" + str(maxbatch) + ")")
         #Notify the queue that we are ready to receive a batch.
-        batch_deferred = self.queue.json_rpcqueue_get(self.maxbatch)
-        batch_deferred.addCallback(self._process_batch)
+        batch_deferred = self.queue.json_rpcqueue_get(maxbatch)
+        batch_deferred.addCallback(self._process_batch, host)
@@ -1,2 +1,3 @@
 """Twisted implementations of STEEM specific classes"""
 from txjsonrpcqueue.steem.injector import EmbeddedHealthHostInjector
+from txjsonrpcqueue.steem.streamer import BlockStreamer
@@ -0,0 +1,48 @@
+"""Twisted implementation of the prefetching block streamer"""
+from twisted.internet import defer
+from txjsonrpcqueue import Portable
+from txjsonrpcqueue.core.steem.streamer import CoreBlockStreamer
+
+class BlockStreamer(object):
+    """Streams blocks from a WildcardQueue in order, following the chain head if end is None.
+
+    on_block is called with the block number and the block. If it returns a deferred, the
+    next block waits for it. The deferred returned by start fires with the number of
+    blocks once end is reached, or fails if on_block raised.
+    """
+    #pylint: disable=too-many-arguments
+    def __init__(self, queue, on_block, start, end=None, window=100, poll_interval=3.0,
+                 irreversible=False, on_error=None):
+        self.on_block = on_block
+        self.done = defer.Deferred()
+        self.count = 0
+        #Serializes the calls to on_block
+        self.chain = defer.succeed(None)
+        self.core = CoreBlockStreamer(Portable(), queue, self._on_block, start, end, window,
+                                      poll_interval, irreversible, on_error, self._on_done)
+    def start(self):
+        """Start streaming, returns a deferred that fires when done"""
+        self.core.start()
+        return self.done
+    def stop(self):
+        """Stop streaming"""
+        self.core.stop()
+    def _on_block(self, block_num, block):
+        def consume(_):
+            if self.done.called:
+                return None
+            return self.on_block(block_num, block)
+        def consumed(_):
+            self.count += 1
+            self.core.release()
+        def failed(failure):
+            self.core.stop()
+            if not self.done.called:
+                self.done.errback(failure)
+        self.chain.addCallback(consume)
+        self.chain.addCallbacks(consumed, failed)
+    def _on_done(self):
+        def finished(_):
+            if not self.done.called:
+                self.done.callback(self.count)
+        self.chain.addCallback(finished)
@@ -1,9 +1,13 @@
 """Twisted  WildcardQue implementation"""
 #pylint: disable=missing-docstring
+import time
 from twisted.internet import task
 from twisted.internet import reactor
 from twisted.internet import defer
-from txjsonrpcqueue.core.wildcardqueue import WildcardMethod, CoreWildcardQueue
+from txjsonrpcqueue.core.wildcardqueue import WildcardMethod, CoreWildcardQueue, CoreLaneQueue
+from txjsonrpcqueue.core.wildcardqueue import CoreBulk, Task, bulk_caller
+from txjsonrpcqueue.core.codec import get_codec
+from txjsonrpcqueue.exception import DeadlineExceeded
 
 class _TxSoon(object):
     """Helper class for making core hysteresis queue event framework agnostic"""
@@ -11,19 +15,168 @@ class _TxSoon(object):
     def __call__(self, callback, argument):
         task.deferLater(reactor, 0.0, callback, argument)
 
-def _tx_set_deferred(dct):
-    dct["deferred"] = defer.Deferred()
+class _TxDeferredOps(object):
+    """Twisted (deferred) implementation of the task operations WildcardMethod needs"""
+    #pylint: disable=no-self-use
+    def set(self, ttask, canceller=None):
+        ttask.fod = defer.Deferred(canceller)
+    def get(self, ttask):
+        return ttask.fod
+    def set_error(self, ttask, err):
+        ttask.fod.errback(err)
+    def follow(self, ttask, done=None, deadline=None):
+        """Create a deferred that follows the result of the (coalesced) deferred in ttask,
+           failing with DeadlineExceeded if still unresolved after deadline seconds"""
+        if ttask.followers is None:
+            #First follower, the deferred in ttask becomes internal and dispatches to followers.
+            ttask.followers = list()
+            def on_result(result):
+                done()
+                for follower in ttask.followers:
+                    if not follower.called:
+                        follower.callback(result)
+            def on_failure(failure):
+                done()
+                for follower in ttask.followers:
+                    if not follower.called:
+                        follower.errback(failure)
+            ttask.fod.addCallbacks(on_result, on_failure)
+        def cancel(follower):
+            #The last caller waiting for the command gave up, so cancel the command itself.
+            if all(other.called for other in ttask.followers if other is not follower):
+                ttask.fod.cancel()
+        follower = defer.Deferred(cancel)
+        ttask.followers.append(follower)
+        if deadline is not None:
+            def expire():
+                if not follower.called:
+                    follower.errback(DeadlineExceeded("Command deadline exceeded"))
+                    cancel(follower)
+            #pylint: disable=no-member
+            timer = reactor.callLater(deadline, expire)
+            def cancel_timer(result):
+                if timer.active():
+                    timer.cancel()
+                return result
+            follower.addBoth(cancel_timer)
+        return follower
+    def resolved(self, result):
+        return defer.succeed(result)
+    def watch(self, ttask, on_result):
+        """Let on_result see the result of the deferred in ttask without consuming it"""
+        def on_ok(result):
+            on_result(result)
+            return result
+        ttask.fod.addCallback(on_ok)
+    def expire_later(self, ttask, seconds, abandon, parked=False):
+        """Fail the deferred in ttask with DeadlineExceeded if still unresolved after seconds,
+           with parked set fail it with BufferError if still parked in the queue"""
+        def expire():
+            if ttask.fod.called or (parked and not ttask.parked):
+                return
+            if parked:
+                ttask.fod.errback(BufferError("No room in WildcardQueue within max wait"))
+            else:
+                ttask.fod.errback(DeadlineExceeded("Command deadline exceeded"))
+            abandon(ttask.lane)
+        #pylint: disable=no-member
+        timer = reactor.callLater(seconds, expire)
+        def cancel_timer(result):
+            if timer.active():
+                timer.cancel()
+            return result
+        ttask.fod.addBoth(cancel_timer)
+    def wake(self, ttask):
+        """Fire the deferred of a room waiter"""
+        if not ttask.fod.called:
+            ttask.fod.callback(None)
+    def skip(self, ttask):
+        """Check if a queued task should no longer be sent, failing it if it expired"""
+        if ttask.fod.called:
+            return True
+        if ttask.deadline is not None and ttask.deadline <= time.time():
+            ttask.fod.errback(DeadlineExceeded("Command deadline exceeded"))
+            return True
+        return False
 
-def _tx_set_error(dct, err):
-    dct["deferred"].errback(err)
+_TX_OPS = _TxDeferredOps()
+
+def _tx_canceller(core, lane=None):
+    """Canceller for the deferreds of queued calls, lets the queue drop a cancelled call"""
+    def cancel(deferred):
+        deferred.errback(defer.CancelledError())
+        core.abandon(lane)
+    return cancel
+
+def _tx_cancel(core):
+    #Cancel the commands whose results were not consumed, without unhandled error noise.
+    for deferred in core.close():
+        deferred.addErrback(lambda failure: None)
+        deferred.cancel()
+
+@defer.inlineCallbacks
+def _tx_bulk(core, on_result, return_exceptions):
+    """Feed the results of a bulk call to on_result in input order"""
+    results = None
+    if on_result is None:
+        results = list()
+        on_result = results.append
+    count = 0
+    try:
+        while True:
+            deferred = core.next()
+            if deferred is None:
+                break
+            try:
+                result = yield deferred
+            except Exception as exception: #pylint: disable=broad-except
+                if not return_exceptions:
+                    raise
+                result = exception
+            consumed = on_result(result)
+            if isinstance(consumed, defer.Deferred):
+                #The consumer is busy, don't take the next result before it is done.
+                yield consumed
+            count += 1
+    finally:
+        _tx_cancel(core)
+    return results if results is not None else count
 
 class WildcardQueue(object):
     # pylint: disable=too-few-public-methods
     """Twisted based hysteresis queue wrapper"""
-    def __init__(self, low=8000, high=10000, highwater=None, lowwater=None, namespace=None):
+    def __init__(self, low=8000, high=10000, highwater=None, lowwater=None, namespace=None,
+                 coalesce=False, cache=None, default_deadline=None, lanes=None,
+                 lane_weights=None, lane_watermarks=None, namespace_lanes=None, codec=None,
+                 backpressure=False, max_wait=None):
         #pylint: disable=too-many-arguments
+        #Cached WildcardMethod objects by namespace or method name
+        self.proxies = dict()
         self.namespace = namespace
-        self.core = CoreWildcardQueue(_TxSoon(), low, high, highwater, lowwater)
+        #Map of identical queued or in-flight calls, if coalescing is enabled.
+        self.coalesced = dict() if coalesce else None
+        #Optional ResponseCache in front of the queue.
+        self.cache = cache
+        #Deadline in seconds for calls that don't specify a _deadline themselves.
+        self.default_deadline = default_deadline
+        #Map from namespace or full method name to priority lane.
+        self.namespace_lanes = namespace_lanes
+        #Params get JSON encoded when queued, with the fastest codec installed by default.
+        if codec is None or isinstance(codec, str):
+            codec = get_codec(codec)
+        self.dumps = codec.dumps
+        #With backpressure calls to a full queue wait for room, for at most max_wait seconds.
+        self.max_wait = max_wait
+        if lanes:
+            #Priority lanes, highest priority first, each with its own hysteresis.
+            self.core = CoreLaneQueue(_TxSoon(), lanes, low, high, highwater, lowwater, _TX_OPS.skip,
+                                      lane_weights, lane_watermarks, backpressure, _TX_OPS.wake)
+        else:
+            self.core = CoreWildcardQueue(_TxSoon(), low, high, highwater, lowwater, _TX_OPS.skip,
+                                          backpressure, _TX_OPS.wake)
+        self.canceller = _tx_canceller(self.core)
+        #Cancellers by lane, so a cancelled call only counts for its own lane
+        self.cancellers = dict((lane, _tx_canceller(self.core, lane)) for lane in lanes or ())
     def json_rpcqueue_get(self, maxbatch=10):
         """Fetch an entry from the queue, imediately if possible,
            or remember callback for when an entry becomes available."""
@@ -32,5 +185,39 @@ class WildcardQueue(object):
         return deferred_get
     def json_rpcqueue_again(self, batch):
         self.core.again(batch)
+    def bulk(self, method, params_iterable, window=100, on_result=None, return_exceptions=False):
+        """Call method once for every item of params_iterable, with at most window calls
+           in the queue or in flight, and call on_result with every result in input order.
+           If on_result returns a deferred, the next result waits for it. The returned
+           deferred fires with the number of results, or with the list of results if no
+           on_result was given. A failed call fails the returned deferred and cancels the
+           rest, unless return_exceptions is set, then on_result gets the exception."""
+        #pylint: disable=too-many-arguments
+        return _tx_bulk(CoreBulk(bulk_caller(self, method), params_iterable, window),
+                        on_result, return_exceptions)
+    def room(self, lane=None, max_wait=None):
+        """Deferred that completes once the queue, or lane, takes calls again. Producers
+           waiting for room are woken in FIFO order, after the calls parked before them
+           by a queue with backpressure. Fails with BufferError after max_wait seconds,
+           the max_wait of the queue by default."""
+        waiter = Task(None, None, lane)
+        _TX_OPS.set(waiter, self.cancellers.get(lane, self.canceller))
+        if max_wait is None:
+            max_wait = self.max_wait
+        if max_wait is not None:
+            _TX_OPS.expire_later(waiter, max_wait, self.core.abandon, True)
+        self.core.room(waiter)
+        return waiter.fod
+    def proxy(self, outername):
+        """The cached WildcardMethod for a namespace or a method in the default namespace"""
+        proxy = self.proxies.get(outername)
+        if proxy is None:
+            proxy = self.proxies[outername] = WildcardMethod(outername, self, _TX_OPS)
+        return proxy
     def __getattr__(self, outername):
-        return WildcardMethod(outername, self, _tx_set_deferred, _tx_set_error)
+        if outername.startswith("__"):
+            raise AttributeError(outername)
+        proxy = self.proxy(outername)
+        #Later lookups of outername find the proxy without calling __getattr__.
+        self.__dict__[outername] = proxy
+        return proxy